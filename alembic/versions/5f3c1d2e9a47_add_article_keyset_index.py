@@ -0,0 +1,26 @@
+"""add article keyset index
+
+Revision ID: 5f3c1d2e9a47
+Revises: 3b6c8b8be5ab
+Create Date: 2026-10-17 10:12:31.208113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3c1d2e9a47'
+down_revision = '3b6c8b8be5ab'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_article_category_id_create_time', 'article',
+                    ['category_id', 'create_time', 'article_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_article_category_id_create_time', table_name='article')
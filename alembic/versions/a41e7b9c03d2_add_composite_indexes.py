@@ -0,0 +1,32 @@
+"""add composite indexes
+
+Revision ID: a41e7b9c03d2
+Revises: 5f3c1d2e9a47
+Create Date: 2026-10-17 11:40:05.917342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41e7b9c03d2'
+down_revision = '5f3c1d2e9a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_category_user_id_category_type', 'category',
+                    ['user_id', 'category_type'], unique=False)
+    # Both are prefixes of the composite indexes now.
+    op.drop_index('ix_article_category_id', table_name='article')
+    op.drop_index('ix_category_user_id', table_name='category')
+
+
+def downgrade():
+    op.create_index('ix_category_user_id', 'category', ['user_id'],
+                    unique=False)
+    op.create_index('ix_article_category_id', 'article', ['category_id'],
+                    unique=False)
+    op.drop_index('ix_category_user_id_category_type', table_name='category')
@@ -1,14 +1,22 @@
 # coding:utf-8
 """Base module for other views' modules."""
 import json
-import sys
+import logging
 import re
+import socket
 import time
 
 from tornado import gen, httpclient
 from tornado.web import HTTPError, MissingArgumentError, RequestHandler
 from models import Mongo
 from config import CFG as config
+from utils import codec, compress
+from utils.log import body_for_log
+from utils.tracing import Trace, new_request_id
+from workers.manager import UnitOfWork
+from workers.task_database import TASKS
+
+logger = logging.getLogger(__name__)
 
 STATUS_DICT = dict([
     # Normal Error
@@ -35,6 +43,7 @@ STATUS_DICT = dict([
     (3150, 'Chat Member Exists.'),
     (3151, 'Chat Member Not Exists.'),
     (3152, 'No Message Found.'),
+    (4001, 'Invalid upload body.'),
     (4003, 'Permission Denied.'),
     (4004, 'Not Found Error.'),
     (4005, 'Permission Error.'),
@@ -133,9 +142,62 @@ class BaseHandler(RequestHandler, Mongo):
     #     base_static_url=options.BASE_STATIC_URL,
     #     base_resource_url=options.BASE_RESOURCE_URL,
     # )
+
+    # Requests being handled by this process, drained on shutdown.
+    in_flight = 0
+
+    # Addresses allowed to use internal endpoints, see check_internal.
+    internal_allow = frozenset(
+        config.get('metrics.allow', ['127.0.0.1', '::1']))
+
     def __init__(self, application, request, **kwargs):
+        self.trace = Trace(
+            new_request_id(request.headers.get('X-Request-Id')),
+            f'{request.method} {request.path}')
         super(BaseHandler, self).__init__(application, request, **kwargs)
         self.params = None
+        self._user_id = None
+        self._parameters = None
+        self._uow = None
+        self._in_flight = True
+        BaseHandler.in_flight += 1
+
+    def _leave(self):
+        # Called on finish and on a closed connection, count it once.
+        if self._in_flight:
+            self._in_flight = False
+            BaseHandler.in_flight -= 1
+
+    def on_connection_close(self):
+        # A request whose client went away may never finish.
+        self._leave()
+        super(BaseHandler, self).on_connection_close()
+
+    def on_finish(self):
+        self._leave()
+        if self._uow is not None:
+            self._uow.close()
+        self.trace.finish(self.get_status())
+
+    def clear(self):
+        super(BaseHandler, self).clear()
+        self.set_header('X-Request-Id', self.trace.request_id)
+
+    @property
+    def tasks(self):
+        """Database tasks, traced as part of this request."""
+        return TASKS.bind(trace=self.trace)
+
+    @property
+    def uow(self):
+        """Unit of work of this request, see `UnitOfWork`.
+
+        Bind it with `self.tasks.bind(uow=self.uow)`, then `yield
+        self.uow.commit()` once the writes are done.
+        """
+        if self._uow is None:
+            self._uow = UnitOfWork()
+        return self._uow
 
     # Rewrite abstract method
 
@@ -191,14 +253,16 @@ class BaseHandler(RequestHandler, Mongo):
 
         if not body:
             body = dict()
-        back_info = yield httpclient.AsyncHTTPClient().fetch(
-            url,
-            method=method,
-            headers=_headers,
-            body=json.dumps(body),
-            raise_error=False,
-            allow_nonstandard_methods=True,
-        )
+        back_info = yield self.trace.track(
+            f'fetch {method} {url}',
+            httpclient.AsyncHTTPClient().fetch(
+                url,
+                method=method,
+                headers=_headers,
+                body=codec.dumps(body),
+                raise_error=False,
+                allow_nonstandard_methods=True,
+            ))
 
         res = dict(
             http_code=back_info.code,
@@ -208,19 +272,21 @@ class BaseHandler(RequestHandler, Mongo):
         if back_info.code >= 400:
             return Arguments(res)
         try:
-            info = json.loads(res['res_body'])
+            info = codec.loads(back_info.body)
             res.update(info)
-        except json.JSONDecodeError:
+        except codec.DecodeError:
             pass
 
         return Arguments(res)
 
     def get_current_user(self):
-        """Get the current user from cookie."""
-        user_id = self.get_secure_cookie('uoo')
-        if isinstance(user_id, bytes):
-            user_id = user_id.decode()
-        return user_id
+        """Get the current user from cookie, decoded once per request."""
+        if self._user_id is None:
+            user_id = self.get_secure_cookie('uoo')
+            if isinstance(user_id, bytes):
+                user_id = user_id.decode()
+            self._user_id = user_id or ''
+        return self._user_id
 
     def set_current_user(self, user_id=''):
         """Set current user to cookie."""
@@ -229,17 +295,32 @@ class BaseHandler(RequestHandler, Mongo):
             user_id,
             expires=time.time() + config.server.expire_time,
             domain=self.request.host)
+        self._user_id = user_id
 
     def get_parameters(self):
-        """Get user information from cookie."""
-        params = self.get_secure_cookie('poo')
-        params = json.loads(params.decode()) if params else dict()
-        return Arguments(params)
-
-    def set_parameters(self, params='', expire_time=3600):
-        """Set user information to the cookie."""
+        """Get user information from cookie, decoded once per request."""
+        if self._parameters is None:
+            params = self.get_secure_cookie('poo')
+            params = json.loads(params.decode()) if params else dict()
+            self._parameters = Arguments(params)
+        return self._parameters
+
+    def set_parameters(self, params='', expire_time=None, reissue=False):
+        """Set user information to the cookie.
+
+        A non empty dict is stamped with its issue time in `_issued`. One
+        it carries already is kept unless `reissue` is set, since `uoo` is
+        not issued again along with it and is refreshed by that time.
+        """
+        if expire_time is None:
+            expire_time = config.server.expire_time
         if isinstance(params, dict):
+            if params and (reissue or '_issued' not in params):
+                params = dict(params, _issued=int(time.time()))
+            self._parameters = Arguments(params)
             params = json.dumps(params)
+        else:
+            self._parameters = None
         self.set_secure_cookie(
             'poo',
             params,
@@ -247,6 +328,44 @@ class BaseHandler(RequestHandler, Mongo):
             domain=self.request.host)
         self.params = params
 
+    def refresh_session(self, params):
+        """Re-issue the auth cookies once they are old enough.
+
+        Cookies are refreshed after `server.refresh_fraction` of their
+        lifetime has passed, so most requests do not rewrite them. Cookies
+        issued before `_issued` existed are refreshed at once.
+        """
+        lifetime = config.server.expire_time
+        fraction = config.get('server.refresh_fraction', 0.5)
+        issued = params.arguments.get('_issued', 0)
+        if time.time() - issued < lifetime * fraction:
+            return
+        self.set_current_user(self.get_current_user())
+        self.set_parameters(params.arguments, reissue=True)
+
+    def peer_ip(self):
+        """Address of the connected peer, whatever the headers say."""
+        context = self.request.connection.context
+        if getattr(context, 'address_family', None) not in (socket.AF_INET,
+                                                            socket.AF_INET6):
+            return None
+        return context.address[0]
+
+    def check_internal(self):
+        """Check the request may use internal endpoints, 403 if not.
+
+        The server trusts X-Real-Ip and X-Forwarded-For (xheaders), which a
+        client reaching it directly can forge. So the peer of the connection
+        must be allowed as well as `remote_ip`; behind a proxy on an allowed
+        address, the proxy must overwrite X-Real-Ip with the client address.
+        """
+        if self.peer_ip() in self.internal_allow and \
+                self.request.remote_ip in self.internal_allow:
+            return True
+        self.set_status(403)
+        self.finish('403 Forbidden')
+        return False
+
     def check_auth(self, check_level=1):
         """Check user status."""
         user_id = self.get_current_user()
@@ -257,8 +376,7 @@ class BaseHandler(RequestHandler, Mongo):
             return False
 
         if check_level is 1:
-            self.set_current_user(self.get_current_user())
-            self.set_parameters(self.get_parameters().arguments)
+            self.refresh_session(params)
             return params
 
         if not params.user_id:
@@ -267,8 +385,7 @@ class BaseHandler(RequestHandler, Mongo):
             self.fail(3006)
             return False
         elif check_level is 2:
-            self.set_current_user(self.get_current_user())
-            self.set_parameters(self.get_parameters().arguments)
+            self.refresh_session(params)
             return params
 
         # sess_info = self.wcd_user.find_one({'user_ip': self.request.remote_ip})
@@ -319,16 +436,36 @@ class BaseHandler(RequestHandler, Mongo):
         res = dict(result=1, status=0, msg=msg, data=data)
         self.finish_with_json(res)
 
+    def success_with_etag(self, entry, msg='Successfully.'):
+        """Reply the value of a cache entry, 304 if the client has it.
+
+        The serialized and compressed bodies are kept on the entry.
+        """
+        self.set_header('Etag', entry.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+        res = dict(result=1, status=0, msg=msg, data=entry.value)
+        self.finish_with_json(res, entry=entry)
+
+    def log_body(self, msg, body, level=logging.DEBUG):
+        """Log a request or response body, cut by `body_for_log`.
+
+        Nothing is done unless the level is enabled, so bodies cost
+        nothing to skip in production.
+        """
+        if logger.isEnabledFor(level):
+            logger.log(
+                level, msg,
+                extra=dict(
+                    request_id=self.trace.request_id,
+                    method=self.request.method,
+                    path=self.request.path,
+                    body=body_for_log(body)))
+
     def parse_form_arguments(self, **keys):
         """Parse FORM argument like `get_argument`."""
-        if config.debug:
-            sys.stdout.write('\n\n' + '>' * 80)
-            sys.stdout.write('\n' + (f'Input: '
-                                     f'{self.request.method} '
-                                     f'{self.request.path}') + '\n\n')
-            sys.stdout.write(self.request.body.decode()[:500])
-            sys.stdout.write('\n\n' + '>' * 80 + '\n')
-            sys.stdout.flush()
+        self.log_body('input', self.request.body)
 
         req = dict()
 
@@ -348,35 +485,24 @@ class BaseHandler(RequestHandler, Mongo):
 
     def parse_json_arguments(self, **keys):
         """Parse JSON argument like `get_argument`."""
+        self.log_body('input', self.request.body)
         try:
-            if config.debug:
-                sys.stdout.write('\n\n' + '>' * 80)
-                sys.stdout.write('\n' + (f'Input: '
-                                         f'{self.request.method} '
-                                         f'{self.request.path}') + '\n\n')
-                sys.stdout.write(self.request.body.decode()[:500])
-                sys.stdout.write('\n\n' + '>' * 80 + '\n')
-                sys.stdout.flush()
-            req = json.loads(self.request.body.decode('utf-8'))
-        except json.JSONDecodeError as exception:
+            req = codec.loads(self.request.body)
+        except codec.DecodeError as exception:
             # self.fail(
             #     exc_doc=exception.doc, msg=exception.args[0], status=1)
-            sys.stdout.write(self.request.body.decode())
-            sys.stdout.write('\n')
-            sys.stdout.flush()
-            raise ParseJSONError(exception.doc)
+            self.log_body('invalid JSON', self.request.body, logging.WARNING)
+            raise ParseJSONError(getattr(exception, 'doc', str(exception)))
 
         if not isinstance(req, dict):
-            sys.stdout.write(self.request.body.decode())
-            sys.stdout.write('\n')
-            sys.stdout.flush()
+            self.log_body('JSON not an object', self.request.body,
+                          logging.WARNING)
             raise ParseJSONError('Req should be a dictonary.')
 
         for key in keys:
             if keys[key] is ENFORCED and key not in req:
-                sys.stdout.write(self.request.body.decode())
-                sys.stdout.write('\n')
-                sys.stdout.flush()
+                self.log_body(f'missing argument {key}', self.request.body,
+                              logging.WARNING)
                 raise MissingArgumentError(key)
 
         req['remote_ip'] = self.request.remote_ip
@@ -384,18 +510,38 @@ class BaseHandler(RequestHandler, Mongo):
 
         return Arguments(req)
 
-    def finish_with_json(self, data):
-        """Turn data to JSON format before finish."""
+    def finish_with_json(self, data, entry=None):
+        """Turn data to JSON format before finish.
+
+        If `entry` is given, the body is serialized once and kept on it.
+        """
         self.set_header('Content-Type', 'application/json')
-        if config.debug:
-            sys.stdout.write('' + '-' * 80)
-            sys.stdout.write('\n' + (f'Output: '
-                                     f'{self.request.method} '
-                                     f'{self.request.path}') + '\n\n')
-            sys.stdout.write(str(data))
-            sys.stdout.write('\n\n' + '-' * 80 + '\n\n')
-            sys.stdout.flush()
-        self.finish(json.dumps(data).encode())
+        if entry is None:
+            body = codec.dumps(data)
+        else:
+            body = entry.variant('identity', lambda: codec.dumps(data))
+        self.log_body('output', body)
+        self.finish_compressed(body, entry)
+
+    def finish_compressed(self, body, entry=None):
+        """Finish with body, compressed if it is large and the client can.
+
+        If `entry` is given, the compressed body is kept on it, so cached
+        payloads are not compressed again for every request.
+        """
+        content_type = self._headers.get('Content-Type', '')
+        if compress.is_compressible(content_type, len(body)):
+            self.set_header('Vary', 'Accept-Encoding')
+            encoding = compress.accepted_encoding(
+                self.request.headers.get('Accept-Encoding', ''))
+            if encoding and entry is None:
+                body = compress.compress(body, encoding)
+                self.set_header('Content-Encoding', encoding)
+            elif encoding:
+                body = entry.variant(
+                    encoding, lambda: compress.compress(body, encoding))
+                self.set_header('Content-Encoding', encoding)
+        self.finish(body)
 
     def pattern_match(self, pattern_name, string):
         """Check given string."""
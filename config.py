@@ -36,6 +36,17 @@ class Config:
         else:
             KeyError(f"Unrecognized option {key}")
 
+    def get(self, path, default=None):
+        """Get an option by dotted path, return default if it is missing."""
+        attr = self
+        for name in path.split('.'):
+            if not isinstance(attr, Config):
+                return default
+            attr = attr.__getattr__(name)
+            if attr is None:
+                return default
+        return attr
+
     def traverse(self, pre=''):
         """Traverse a Config instance."""
         all_config = dict()
@@ -1,18 +1,24 @@
 #!/usr/local/bin/python3
 # coding:utf-8
 """Main module of eSignDB."""
+import logging
 import os
-import sys
-import json
+from datetime import timedelta
 
 import tornado
 
-from tornado import gen, httpserver, ioloop, web
+from tornado import gen, httpserver, ioloop, netutil, web
 
 from base_handler import BaseHandler
 from config import CFG as config
+from static_handler import StaticAssetHandler
+from utils import image_variant, log, metrics
+from utils.prefork import fork_workers, install_graceful_shutdown
+from utils.tracing import SLOW_MS, SLOW_TRACES
 from views import HANDLER_LIST
 
+logger = logging.getLogger(__name__)
+
 
 class IndexHandler(BaseHandler):
     """Test index request handler."""
@@ -38,25 +44,25 @@ class TestHandler(BaseHandler):
     def get(self, *_args, **_kwargs):
         """Test GET."""
         res = dict(method='GET', path=_kwargs.get('path'))
-        print(self.request.body[:200])
+        self.log_body('test', self.request.body)
         self.finish_with_json(res)
 
     def post(self, *_args, **_kwargs):
         """Test POST."""
         res = dict(method='POST', path=_kwargs.get('path'))
-        print(self.request.body[:200])
+        self.log_body('test', self.request.body)
         self.finish_with_json(res)
 
     def put(self, *_args, **_kwargs):
         """Test PUT."""
         res = dict(method='PUT', path=_kwargs.get('path'))
-        print(self.request.body[:200])
+        self.log_body('test', self.request.body)
         self.finish_with_json(res)
 
     def delete(self, *_args, **_kwargs):
         """Test DELETE."""
         res = dict(method='DELETE', path=_kwargs.get('path'))
-        print(self.request.body[:200])
+        self.log_body('test', self.request.body)
         self.finish_with_json(res)
 
 
@@ -70,53 +76,118 @@ class TestFinish(BaseHandler):
     @tornado.gen.coroutine
     def get(self):
         self.cut()
-        print('test success')
+        logger.debug('test success')
 
 
-class ServiceWorkerHandler(BaseHandler):
-    """Test method."""
+class ServiceWorkerHandler(StaticAssetHandler):
+    """Serve service-worker.js, browsers must revalidate it."""
 
-    def get(self, *_args, **kwargs):
-        """Test GET."""
-        self.set_header("Content-Type", "application/javascript")
-        with open('../wcd-ui/src/assets/js/service-worker.js',
-                  'rb') as sw_file:
-            self.finish(sw_file.read())
+    def initialize(self, **_kwargs):
+        super(ServiceWorkerHandler, self).initialize(
+            path='../wcd-ui/src/assets/js')
 
+    def get(self, path='service-worker.js', include_body=True):
+        return super(ServiceWorkerHandler, self).get(
+            'service-worker.js', include_body)
 
-class ImageHandler(BaseHandler):
-    """Test method."""
+    def head(self, path='service-worker.js'):
+        return self.get(path, include_body=False)
+
+
+class InternalHandler(BaseHandler):
+    """Base of internal endpoints, only the addresses allowed may use."""
+
+    def prepare(self):
+        self.check_internal()
+
+
+class MetricsHandler(InternalHandler):
+    """Serve metrics to Prometheus."""
+
+    def get(self, *_args, **_kwargs):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics.expose())
 
-    def get(self, image_id, image_type, *_args, **kwargs):
-        """Test GET."""
-        if image_type == '.jpg':
-            self.set_header("Content-Type", "image/jpeg")
-        elif image_type == '.png':
-            self.set_header("Content-Type", "image/png")
-        elif image_type == '.gif':
-            self.set_header("Content-Type", "image/GIF")
-
-        try:
-            with open('../static/image/' + image_id + image_type,
-                      'rb') as sw_file:
-                self.finish(sw_file.read())
-        except FileNotFoundError as exception:
-            self.set_status(404)
-            self.finish('404 File Not Found')
+
+class SlowTraceHandler(InternalHandler):
+    """Dump the slow request traces, the slowest first."""
+
+    def get(self, *_args, **_kwargs):
+        traces = sorted(
+            SLOW_TRACES, key=lambda trace: trace['duration_ms'], reverse=True)
+        self.success(data=dict(slow_ms=SLOW_MS, traces=traces))
+
+
+class ImageHandler(StaticAssetHandler):
+    """Serve uploaded images, they never change once written.
+
+    With `?w=<width>` a variant at most that wide is served instead, see
+    utils/image_variant.py. Until the variant is made the original is
+    served, uncached.
+    """
+
+    def initialize(self, **_kwargs):
+        super(ImageHandler, self).initialize(
+            path=image_variant.VARIANTS.root,
+            max_age=config.get('static.image_max_age', 86400 * 30))
+
+    @gen.coroutine
+    def get(self, path, include_body=True):
+        width = image_variant.pick_width(self.get_argument('w', None), path)
+        if width is None:
+            yield super(ImageHandler, self).get(path, include_body)
+            return
+
+        fmt = None
+        if image_variant.WEBP:
+            self.set_header('Vary', 'Accept')
+            if 'image/webp' in self.request.headers.get('Accept', ''):
+                fmt = 'webp'
+        name = image_variant.variant_name(path, width, fmt)
+        variants = image_variant.VARIANTS
+
+        if variants.lookup(name):
+            image_variant.VARIANT_REQUESTS.inc(result='hit')
+        elif not os.path.isfile(os.path.join(self.root, path)):
+            yield super(ImageHandler, self).get(path, include_body)
+            return
+        else:
+            try:
+                yield gen.with_timeout(
+                    timedelta(seconds=image_variant.WAIT),
+                    variants.make(os.path.join(self.root, path), name,
+                                  width, fmt))
+                image_variant.VARIANT_REQUESTS.inc(result='made')
+            except Exception:
+                image_variant.VARIANT_REQUESTS.inc(result='original')
+                self.max_age = 0
+                yield super(ImageHandler, self).get(path, include_body)
+                return
+        yield super(ImageHandler, self).get(name, include_body)
 
 
 def main():
     """Esign DB program main function."""
 
+    # Autoreload of debug mode does not work with forked workers.
+    processes = 1 if config.debug else config.get('server.processes', 1)
+
+    log.setup()
+
+    sockets = netutil.bind_sockets(config.server.port)
+    if processes != 1:
+        fork_workers(processes, config.get('server.max_restarts', 100))
+
     handlers = [
         (r'/', IndexHandler),
         (r'/text', TextHandler),
         (r'/back/api/explain', TextHandler),
         (r'/test(?P<path>.*)?', TestHandler),
-        (r'/image/(?P<image_id>[a-zA-Z0-9\-]{36})(?P<image_type>.jpg|.png|.gif)',
-         ImageHandler),
+        (r'/image/([a-zA-Z0-9\-]{36}\.(?:jpg|png|gif))', ImageHandler),
         (r'/finish', TestFinish),
         (r'/service-worker.js', ServiceWorkerHandler),
+        (r'/metrics', MetricsHandler),
+        (r'/admin/traces', SlowTraceHandler),
     ]
 
     handlers += [(f'/middle{handler[0]}', handler[1])
@@ -134,12 +205,13 @@ def main():
         xheaders=True,
     )
 
-    tornado_server.listen(config.server.port)
-    print('start listen...')
-    sys.stdout.write('\nconfig:\n')
-    json.dump(config.traverse(), sys.stdout, indent=4, sort_keys=True)
-    sys.stdout.write('\n\n\n')
-    sys.stdout.flush()
+    tornado_server.add_sockets(sockets)
+    install_graceful_shutdown(
+        tornado_server,
+        lambda: BaseHandler.in_flight,
+        config.get('server.shutdown_wait', 10))
+    logger.info('start listen', extra=dict(port=config.server.port))
+    logger.debug('config', extra=dict(config=config.traverse()))
 
     ioloop.IOLoop.instance().start()
 
@@ -0,0 +1,250 @@
+# coding=utf-8
+"""COS Async Client Module."""
+
+import logging
+from urllib import parse
+
+from requests import Request
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from .bucket import Bucket
+from .client import Config
+from .exception import CosClientError, CosServiceError
+
+logger = logging.getLogger(__name__)
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:  # pycurl 未安装
+    CurlAsyncHTTPClient = None
+
+
+class AsyncClient(Config):
+    """cos 异步客户端类, 请求由 Tornado 的 AsyncHTTPClient 发起
+
+    签名, URL 拼接和异常类型与 `Client` 相同, 请求方法返回 Future.
+    """
+
+    chunk_size = 64 * 1024  # 流式上传时每次读取的字节数
+
+    def __init__(self, **kwargs):
+        """初始化 AsyncClient 类
+
+        :param max_clients(int): 同时进行的请求数, 超出的请求排队等待.
+        :param backend(str): 'simple' 或 'curl', curl 会复用连接, 需要 pycurl.
+        :param endpoint(str): 替代 COS 域名的地址, 如本地的 stub 服务.
+        :param connect_timeout(int): 连接超时时间.
+        其余参数同 `Client`.
+        """
+        super().__init__(**kwargs)
+        self._token = kwargs.get('token', '')
+        self._timeout = kwargs.get('timeout', 30)
+        self._connect_timeout = kwargs.get('connect_timeout', 10)
+        self._retry = kwargs.get('retry', 1)
+        self._max_clients = kwargs.get('max_clients', 10)
+        self._backend = kwargs.get('backend', 'simple')
+        self._endpoint = (kwargs.get('endpoint') or '').rstrip('/')
+        self._http_client = None
+
+    @property
+    def http_client(self):
+        """首次使用时创建, 以绑定到当前进程的 IOLoop."""
+        if self._http_client is None:
+            client_class = AsyncHTTPClient
+            if self._backend == 'curl':
+                if CurlAsyncHTTPClient is None:
+                    logger.warning('pycurl not installed, use simple client')
+                else:
+                    client_class = CurlAsyncHTTPClient
+            self._http_client = client_class(
+                force_instance=True, max_clients=self._max_clients)
+        return self._http_client
+
+    def close(self):
+        """关闭 http client."""
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
+    def get_url(self, path='', params=None, **kwargs):
+        """拼接URL, 设置了 endpoint 时请求发往 endpoint, 否则发往 COS 域名"""
+        if not self._endpoint:
+            return super().get_url(path=path, params=params, **kwargs)
+        result = self._endpoint + '/' + parse.quote(path, '/-_.~').lstrip('/')
+        if params:
+            result += '?' + parse.urlencode(params)
+        return result
+
+    def sign(self, method, path, headers, params=None):
+        """用 `Auth` 计算签名, 设置到 headers 的 Authorization 中"""
+        auth = self.auth(path, params=params)
+        auth(Request(method=method, headers=headers))
+        return headers
+
+    def _body_producer(self, body):
+        """生成从文件对象中分块读取的 body_producer"""
+
+        @gen.coroutine
+        def produce(write):
+            """Write the file chunk by chunk."""
+            while True:
+                chunk = body.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield write(chunk)
+
+        return produce
+
+    @staticmethod
+    def _body_length(body):
+        """文件对象剩余的长度"""
+        position = body.tell()
+        body.seek(0, 2)
+        length = body.tell() - position
+        body.seek(position)
+        return length
+
+    @gen.coroutine
+    def send_request(self, method, url, path='/', data=None, headers=None,
+                     timeout=None):
+        """发起http请求, data 为 bytes 或文件对象, 文件对象会分块上传"""
+        headers = dict(headers or {})
+        headers['User-Agent'] = 'cos-python-sdk-v5'
+        if self._token:
+            headers['x-cos-security-token'] = self._token
+
+        stream = data is not None and hasattr(data, 'read')
+        if stream:
+            start = data.tell()
+            headers['Content-Length'] = str(self._body_length(data))
+        elif method in ('POST', 'PUT') and data is None:
+            data = b''
+
+        res = None
+        for _ in range(self._retry):
+            if stream:
+                data.seek(start)
+            request = HTTPRequest(
+                url,
+                method=method,
+                headers=self.sign(method, path, dict(headers)),
+                body=None if stream else data,
+                body_producer=self._body_producer(data) if stream else None,
+                connect_timeout=self._connect_timeout,
+                request_timeout=timeout or self._timeout)
+            try:
+                res = yield self.http_client.fetch(request, raise_error=False)
+            except Exception as e:  # 连接失败等客户端错误, 转化为客户端错误
+                logger.exception('url:%s, exception:%s', url, e)
+                raise CosClientError(str(e))
+            if res.code == 599:
+                logger.warning('url:%s, exception:%s', url, res.error)
+                raise CosClientError(str(res.error))
+            if res.code < 300:
+                return res
+
+        text = res.body.decode(errors='replace') if res.body else ''
+        logger.warning(
+            'cos error response',
+            extra=dict(
+                url=url,
+                status_code=res.code,
+                request_id=res.headers.get('x-cos-request-id'),
+                body=text[:512]))
+        if method == 'HEAD' and res.code == 404:
+            msg = dict(
+                code='NoSuchResource',
+                message='The Resource You Head Not Exist',
+                resource=url,
+                requestid=res.headers.get('x-cos-request-id'),
+                traceid=res.headers.get('x-cos-trace-id'))
+        else:
+            msg = text or dict(res.headers)
+        raise CosServiceError(method, msg, res.code)
+
+
+class AsyncBucket(AsyncClient):
+    """Bucket 对象接口的异步版本, 方法返回 Future"""
+
+    @staticmethod
+    def _result(res, body=None):
+        return dict(
+            headers=dict(res.headers),
+            body=res.body.decode(errors='replace') if body is None else body)
+
+    @gen.coroutine
+    def put_object(self, body, path, bucket=None, **kwargs):
+        """单文件上传接口, body 为 bytes 或文件对象
+
+        :param body(file|bytes): 上传的文件内容, 文件对象会分块上传.
+        :param path(string): COS路径.
+        :param bucket(string): 存储桶名称.
+        :kwargs: 设置上传的headers.
+        :return(dict): 上传成功返回的结果，包含ETag等信息.
+        """
+        headers = self.extract_headers(kwargs)
+        headers.update(headers.pop('Metadata', {}))
+        url = self.get_url(bucket=bucket, path=path)
+
+        logger.info('put object, url=:%s ,headers=:%s', url, headers)
+
+        res = yield self.send_request(
+            'PUT', url, path=path, data=body, headers=headers)
+        return self._result(res)
+
+    @gen.coroutine
+    def get_object(self, path, bucket=None, **kwargs):
+        """单文件下载接口, body 为文件内容的 bytes"""
+        headers = self.extract_headers(kwargs)
+        params = {
+            key: headers.pop(key)
+            for key in list(headers) if key.startswith('response')
+        }
+        url = self.get_url(path=path, bucket=bucket, params=params)
+
+        logger.info('get object, url=:%s ,headers=:%s', url, headers)
+
+        res = yield self.send_request('GET', url, path=path, headers=headers)
+        return self._result(res, res.body)
+
+    @gen.coroutine
+    def head_object(self, path, bucket=None, **kwargs):
+        """获取文件信息"""
+        headers = self.extract_headers(kwargs)
+        url = self.get_url(path=path, bucket=bucket)
+
+        logger.info('head object, url=:%s ,headers=:%s', url, headers)
+
+        res = yield self.send_request('HEAD', url, path=path, headers=headers)
+        return self._result(res, '')
+
+    @gen.coroutine
+    def delete_object(self, path, bucket=None, **kwargs):
+        """单文件删除接口"""
+        headers = self.extract_headers(kwargs)
+        url = self.get_url(bucket=bucket, path=path)
+
+        logger.info('delete object, url=:%s ,headers=:%s', url, headers)
+
+        res = yield self.send_request(
+            'DELETE', url, path=path, headers=headers)
+        return self._result(res)
+
+    @gen.coroutine
+    def delete_objects(self, targets, bucket=None, quiet='false', **kwargs):
+        """文件批量删除接口,单次最多支持1000个object"""
+        xml_config = Bucket.delete_objects_body(targets, quiet)
+
+        headers = self.extract_headers(kwargs)
+        headers['Content-MD5'] = self.get_md5(xml_config).decode()
+        headers['Content-Type'] = 'application/xml'
+        url = self.get_url(bucket=bucket) + '?delete'
+
+        logger.info('delete objects, url=:%s, headers=:%s', url, headers)
+
+        res = yield self.send_request(
+            'POST', url, path='/', data=xml_config, headers=headers)
+        return self._result(
+            res,
+            self.xml_to_dict(res.body.decode(), ['Deleted', 'Error']))
@@ -4,17 +4,35 @@
 import hmac
 import logging
 import re
+import threading
 import time
 from hashlib import sha1
 from urllib import parse
 
 from requests.auth import AuthBase
 
+from .comm import ExpiringCache
+
 logger = logging.getLogger(__name__)
 
 
+def derive_sign_key(access_key, expire):
+    """计算签名秘钥, 返回 (sign_time, sign_key, 失效时间)."""
+    now = int(time.time())
+    sign_time = str(now - 60) + ';' + str(now + expire)
+    sign_key = hmac.new(key=access_key.encode(),
+                        msg=sign_time.encode(),
+                        digestmod=sha1).hexdigest()
+    return sign_time, sign_key, now + expire
+
+
 class Auth(AuthBase):
-    """Auth"""
+    """Auth
+
+    传入 factory 时, 签名秘钥由 factory 缓存, 否则每次计算.
+    """
+
+    headers_pattern = re.compile(r'^(Content-Type|Host|[xX].*)$')
 
     def __init__(self, access_id, access_key, path=None, **kwargs):
         self._access_id = access_id
@@ -22,7 +40,7 @@ class Auth(AuthBase):
         self._path = '/' + path.lstrip('/') if path else '/'
         self._expire = kwargs.get('expire', 10000)
         self._params = kwargs.get('params') or {}
-        self.headers_pattern = re.compile(r'^(Content-Type|Host|[xX].*)$')
+        self._factory = kwargs.get('factory')
 
     def __call__(self, req):
         """
@@ -31,9 +49,15 @@ class Auth(AuthBase):
         """
         headers = self._filter_headers(req.headers)
 
-        sign_time, msg = self._render_message(req.method, headers)
+        if self._factory is not None:
+            sign_time, sign_key = self._factory.sign_key(self._expire)
+        else:
+            sign_time, sign_key, _ = derive_sign_key(
+                self._access_key, self._expire)
+
+        msg = self._render_message(req.method, headers, sign_time)
 
-        signature = self._sign(sign_time, msg)
+        signature = self._sign(sign_key, msg)
 
         req.headers['Authorization'] = self._re_assemble_headers(
             sign_time, headers, signature)
@@ -48,9 +72,9 @@ class Auth(AuthBase):
         """
 
         return {item.lower(): data[item] for item in data
-                if re.match(self.headers_pattern, item) and data[item]}
+                if self.headers_pattern.match(item) and data[item]}
 
-    def _render_message(self, method, headers):
+    def _render_message(self, method, headers, sign_time):
         format_str = '{method}\n{host}\n{params}\n{headers}\n'.format(
             method=method.lower(),
             host=self._path,
@@ -58,22 +82,15 @@ class Auth(AuthBase):
             headers=parse.urlencode(sorted(headers.items()), safe='-_.~')
         )
 
-        now = int(time.time())
-        sign_time = str(now - 60) + ';' + str(now + self._expire)
-
         msg = 'sha1\n{sign_time}\n{sha1}\n'.format(
             sign_time=sign_time,
             sha1=sha1(format_str.encode()).hexdigest())
 
         logger.debug('format str: %s', format_str)
         logger.debug('message to sign: %s', msg)
-        return (sign_time, msg)
-
-    def _sign(self, sign_time, msg):
-        sign_key = hmac.new(key=self._access_key.encode(),
-                            msg=sign_time.encode(),
-                            digestmod=sha1).hexdigest()
+        return msg
 
+    def _sign(self, sign_key, msg):
         sign = hmac.new(key=sign_key.encode(),
                         msg=msg.encode(),
                         digestmod=sha1).hexdigest()
@@ -115,19 +132,50 @@ class Auth(AuthBase):
 
 
 class AuthFactory:
-    """保存秘钥, 生成相应的 Auth 实例."""
+    """保存秘钥, 生成相应的 Auth 实例.
+
+    签名秘钥按有效期缓存, 剩余有效时间不足一半时重新计算. 只带 path 和
+    expire 参数的 Auth 实例会被复用.
+    """
 
-    def __init__(self, access_id, access_key):
+    def __init__(self, access_id, access_key, max_size=1024):
+        self._keys = ExpiringCache(16)
+        self._auths = ExpiringCache(max_size)
+        self._lock = threading.Lock()
         self.change_access(access_id, access_key)
 
     def __call__(self, path='/', **kwargs):
         """生成一个 Auth 实例."""
-        return Auth(self.access_id, self.access_key, path, **kwargs)
+        if kwargs.get('params') or set(kwargs) - {'expire', 'params'}:
+            return Auth(
+                self.access_id, self.access_key, path, factory=self, **kwargs)
+        key = (path, kwargs.get('expire'))
+        auth = self._auths.get(key)
+        if auth is None:
+            auth = Auth(
+                self.access_id, self.access_key, path, factory=self, **kwargs)
+            self._auths.set(key, auth, float('inf'))
+        return auth
+
+    def sign_key(self, expire):
+        """返回缓存的 (sign_time, sign_key), 失效前一半时间内复用."""
+        cached = self._keys.get(expire, min_ttl=expire / 2)
+        if cached is None:
+            with self._lock:
+                cached = self._keys.get(expire, min_ttl=expire / 2)
+                if cached is None:
+                    sign_time, sign_key, expire_at = derive_sign_key(
+                        self.access_key, expire)
+                    cached = (sign_time, sign_key)
+                    self._keys.set(expire, cached, expire_at)
+        return cached
 
     def change_access(self, access_id, access_key):
         """修改秘钥"""
         self.access_id = access_id
         self.access_key = access_key
+        self._keys.clear()
+        self._auths.clear()
 
     @staticmethod
     def laugh():
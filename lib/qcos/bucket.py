@@ -2,43 +2,59 @@
 """COS Bucket Module."""
 
 import logging
+import mmap
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
 from xml.etree.ElementTree import Element, SubElement, tostring
 
 from .client import Client
+from .comm import ExpiringCache
 from .exception import CosClientError, CosServiceError
 
-logging.basicConfig(
-    level=logging.INFO,
-    format=
-    '%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-    datefmt='%a, %d %b %Y %H:%M:%S',
-    filename='cos_v5.log',
-    filemode='a')
-
 logger = logging.getLogger(__name__)
 
 
 class Bucket(Client):
     """s3 object interface begin"""
 
+    sign_end_pattern = re.compile(r'q-sign-time=\d+;(\d+)')
+
+    def __init__(self, **kwargs):
+        """初始化 Bucket 类
+
+        :param presigned_cache_size(int): 缓存的预签名URL数量.
+        其余参数同 `Client`.
+        """
+        super().__init__(**kwargs)
+        self._presigned = ExpiringCache(
+            kwargs.get('presigned_cache_size', 1024))
+
     def get_presigned_download_url(self, path, **kwargs):
-        """生成预签名的下载url
+        """生成预签名的下载url, 剩余有效时间超过一半的URL会被复用
 
         :param path(str): COS路径.
         :param expire(int): 签名过期时间.
         :param bucket(str): 存储桶名称.
         :return(str): 预先签名的下载URL.
         """
+        expire = kwargs.get('expire', 300)
+        key = (kwargs.get('bucket') or self.bucket, path, expire)
+        url = self._presigned.get(key, min_ttl=expire / 2)
+        if url is not None:
+            return url
+
         url = self.get_url(path=path, bucket=kwargs.get('bucket'))
         sign = self.get_auth(
-            method='GET',
-            bucket=kwargs.get('bucket'),
-            path=path,
-            expire=kwargs.get('expire', 300))
+            method='GET', bucket=kwargs.get('bucket'), path=path,
+            expire=expire)
+        url += '?' + parse.urlencode(dict(sign=sign))
 
-        return url + parse.urlencode(dict(sign=sign))
+        end = int(self.sign_end_pattern.search(sign).group(1))
+        self._presigned.set(key, url, end)
+        return url
 
     def put_object(self, body, path, bucket=None, headers=None, **kwargs):
         """单文件上传接口，适用于小文件，最大不得超过5GB
@@ -109,13 +125,7 @@ class Bucket(Client):
         :param kwargs(dict): 设置请求headers.
         :return(dict): 批量删除的结果.
         """
-        root = Element('Delete')
-        SubElement(root, 'Quiet').text = quiet
-        for item in targets:
-            object_el = SubElement(root, 'Object')
-            SubElement(object_el, 'Key').text = item
-
-        xml_config = b'<?xml version="1.0" encoding="utf-8" ?>' + tostring(root)
+        xml_config = self.delete_objects_body(targets, quiet)
 
         headers = self.extract_headers(kwargs)
         headers['Content-MD5'] = self.get_md5(xml_config)
@@ -132,6 +142,17 @@ class Bucket(Client):
             headers=dict(res.headers),
             body=self.xml_to_dict(res.text, ['Deleted', 'Error']))
 
+    @staticmethod
+    def delete_objects_body(targets, quiet='false'):
+        """拼接批量删除请求的xml"""
+        root = Element('Delete')
+        SubElement(root, 'Quiet').text = quiet
+        for item in targets:
+            object_el = SubElement(root, 'Object')
+            SubElement(object_el, 'Key').text = item
+
+        return b'<?xml version="1.0" encoding="utf-8" ?>' + tostring(root)
+
     def head_object(self, path, bucket=None, headers=None, **kwargs):
         """获取文件信息
 
@@ -442,45 +463,99 @@ class Bucket(Client):
             headers=dict(res.headers),
             body=self.xml_to_dict(res.text, ['Upload']))
 
-    def _upload_part(self, path, local_path, size, part_num, bucket,
-                     upload_id):
-        """从本地文件中读取分块, 上传单个分块,将结果记录在md5——list中
+    def _uploaded_parts(self, path, upload_id, bucket=None):
+        """列出已上传的全部分片, 返回 {序号: (ETag, 大小)}"""
+        parts = dict()
+        marker = 0
+        while True:
+            body = self.list_parts(
+                path=path,
+                upload_id=upload_id,
+                bucket=bucket,
+                part_number_marker=marker)['body']
+            for item in body.get('Part') or []:
+                parts[int(item['PartNumber'])] = (item['ETag'],
+                                                  int(item['Size']))
+            if body.get('IsTruncated') != 'true':
+                return parts
+            marker = body['NextPartNumberMarker']
+
+    def _find_upload(self, path, bucket=None):
+        """查找这个路径上最近一次未完成的分块上传"""
+        key = path.lstrip('/')
+        body = self.list_multipart_uploads(bucket=bucket, prefix=key)['body']
+        uploads = [
+            item for item in body.get('Upload') or []
+            if parse.unquote(item['Key']) == key
+        ]
+        if not uploads:
+            return None
+        return max(uploads, key=lambda item: item['Initiated'])['UploadId']
+
+    def _upload_part(self, path, view, size, part_num, bucket, upload_id,
+                     stop, retry=3, backoff=0.5):
+        """从文件的内存映射中切出分块并上传, 失败时退避重试
+
+        一个分块失败时设置 stop, 其余分块不再重试.
 
         :param path(string): 分块上传路径名.
-        :param local_path(string): 本地文件路径名.
-        :param offset(int): 读取本地文件的分块偏移量.
-        :param size(int): 读取本地文件的分块大小.
+        :param view(memoryview): 本地文件的内存映射.
+        :param size(int): 分块大小.
         :param part_num(int): 上传分块的序号.
         :param bucket(string): 存储桶名称.
         :param upload_id(string): 分块上传的uploadid.
-        :param etag_lst(list): 保存上传成功分块的MD5和序号.
-        :return: None.
+        :param stop(threading.Event): 这次上传的各分块共用的停止标志.
+        :param retry(int): 单个分块最多尝试的次数.
+        :param backoff(float): 第一次重试前等待的秒数, 之后每次加倍.
+        :return(dict): 分块的序号和ETag.
         """
         offset = size * (part_num - 1)
-        with open(local_path, 'rb') as fp:
-            fp.seek(offset, 0)
-            rt = self.upload_part(
-                body=fp.read(size),
-                path=path,
-                part=part_num,
-                upload_id=upload_id,
-                bucket=bucket)
-        return dict(part_number=str(part_num), etag=rt['headers']['ETag'])
+        for attempt in range(retry):
+            try:
+                with view[offset:offset + size] as body:
+                    rt = self.upload_part(
+                        body=body,
+                        path=path,
+                        part=part_num,
+                        upload_id=upload_id,
+                        bucket=bucket)
+                return dict(
+                    part_number=str(part_num), etag=rt['headers']['ETag'])
+            except (CosClientError, CosServiceError) as e:
+                if isinstance(e, CosServiceError) and \
+                        e.get_status_code() < 500 or attempt + 1 >= retry:
+                    stop.set()
+                    raise
+                logger.warning('upload part %s failed, retry: %s', part_num,
+                               e)
+                # 等待重试时其他分块失败, 立即放弃
+                if stop.wait(backoff * 2**attempt):
+                    raise
 
     def upload_file(self, path, local_path, **kwargs):
-        """小于等于100MB的文件简单上传，大于等于100MB的文件使用分块上传
+        """小于等于10MB的文件简单上传，更大的文件并发分块上传
+
+        分块从文件的内存映射中切出, 不复制. 传入 upload_id, 或 resume 为
+        True 时查找这个路径上未完成的上传, 已上传的分块会被跳过. 分块上传
+        失败时保留这次上传, 以便之后续传.
 
         :param key(str): 分块上传路径名.
         :param local_path(str): 本地文件路径名.
         :param bucket(str): 存储桶名称.
-        :param part_size(int): 分块的大小设置.
+        :param part_size(int): 分块的大小设置, 单位MB.
         :param max_thread(int): 并发上传的最大线程数.
+        :param part_retry(int): 单个分块最多尝试的次数.
+        :param upload_id(str): 要续传的分块上传.
+        :param resume(bool): 是否查找未完成的分块上传续传.
         :param kwargs(dict): 设置请求headers.
-        :return: None.
+        :return(dict): 上传成功返回的结果.
         """
-        size = kwargs.get('size', 10)
-        # max_thread = kwargs.get('max_thread', 5)
-        bucket = kwargs.get('bucket')
+        part_size = kwargs.pop('part_size', kwargs.pop('size', 10))
+        max_thread = kwargs.pop('max_thread', 5)
+        part_retry = kwargs.pop('part_retry', 3)
+        upload_id = kwargs.pop('upload_id', None)
+        resume = kwargs.pop('resume', False)
+        bucket = kwargs.pop('bucket', None)
         file_size = os.path.getsize(local_path)
 
         if file_size > 1024 * 1024 * 1024 * 100:
@@ -492,33 +567,68 @@ class Bucket(Client):
                 return self.put_object(
                     bucket=bucket, path=path, body=fp, **kwargs)
 
-        part_size = 1024 * 1024 * size  # 默认按照10MB分块,最大支持100G的文件，超过100G的分块数固定为10000
-        parts_num = round(file_size / part_size + 0.5)
+        # 默认按照10MB分块, 分块数超过10000时加大分块
+        part_size = max(1024 * 1024 * part_size, -(-file_size // 10000))
+        parts_num = -(-file_size // part_size)
 
-        # 创建分块上传
-        upload_id = self.create_group(
-            bucket=bucket, path=path, **kwargs)['body']['UploadId']
+        if upload_id is None and resume:
+            upload_id = self._find_upload(path, bucket)
 
-        # 上传分块
-        etag_lst = [
-            self._upload_part(
-                bucket=bucket,
-                path=path,
-                local_path=local_path,
-                size=part_size,
-                part_num=i,
-                upload_id=upload_id) for i in range(1, parts_num + 1)
-        ]
+        uploaded = dict()
+        if upload_id is None:
+            # 创建分块上传
+            upload_id = self.create_group(
+                bucket=bucket, path=path, **kwargs)['body']['UploadId']
+        else:
+            uploaded = self._uploaded_parts(path, upload_id, bucket)
+
+        etag_lst = []
+        todo = []
+        for i in range(1, parts_num + 1):
+            expect = min(part_size, file_size - part_size * (i - 1))
+            if i in uploaded and uploaded[i][1] == expect:
+                etag_lst.append(dict(part_number=str(i), etag=uploaded[i][0]))
+            else:
+                todo.append(i)
+
+        # 并发上传分块
+        stop = threading.Event()
+        with open(local_path, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as view, \
+                ThreadPoolExecutor(max_thread) as executor:
+            futures = [
+                executor.submit(
+                    self._upload_part,
+                    bucket=bucket,
+                    path=path,
+                    view=view,
+                    size=part_size,
+                    part_num=i,
+                    upload_id=upload_id,
+                    stop=stop,
+                    retry=part_retry) for i in todo
+            ]
+            try:
+                etag_lst.extend(future.result() for future in futures)
+            except Exception:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                logger.error('upload parts failed, resume with upload_id %s',
+                             upload_id)
+                raise
+
+        etag_lst.sort(key=lambda item: int(item['part_number']))
 
         # 完成分片上传
         try:
             res = self.end_group(
                 bucket=bucket, path=path, upload_id=upload_id, parts=etag_lst)
         except (CosClientError, CosServiceError) as e:
-            res = self.abort_group(
-                bucket=bucket, path=path, upload_id=upload_id)
+            self.abort_group(bucket=bucket, path=path, upload_id=upload_id)
             raise e
-        return dict(headers=dict(res.headers), body=res.text)
+        return res
 
     def upload_part_copy(self,
                          path,
@@ -14,14 +14,6 @@ from .auth import AuthFactory
 from .comm import XMLParser
 from .exception import CosClientError, CosServiceError
 
-logging.basicConfig(
-    level=logging.INFO,
-    format=
-    '%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-    datefmt='%a, %d %b %Y %H:%M:%S',
-    filename='cos_v5.log',
-    filemode='a')
-
 logger = logging.getLogger(__name__)
 
 
@@ -135,6 +127,29 @@ class Config(object):
         logger.info('config parameter-> appid: %s, region: %s', self.appid,
                     self.region)
 
+    def get_url(self, path='', params=None, **kwargs):
+        """拼接URL
+
+        :param path(str): 请求COS的路径.
+        :param params(str): 请求参数.
+        :param bucket(str): 存储桶名称.
+        :param appid(str): APPID.
+        :param region(str): 存储节点名称.
+        :param scheme(str): 请求协议 http/https.
+        :return(str): 拼接好的URL.
+        """
+
+        result = '{bucket}-{appid}.{region}.myqcloud.com/{path}'.format(
+            bucket=kwargs.get('bucket') or self.bucket,
+            appid=kwargs.get('appid') or self.appid,
+            region=kwargs.get('region') or self.region,
+            path=parse.quote(path, '/-_.~').lstrip('/'))
+        if not kwargs.get('no_scheme'):
+            result = kwargs.get('scheme') or self.scheme + '://' + result
+        if params:
+            result += '?' + parse.urlencode(params or {})
+        return result
+
     def format_region(self, region):
         """格式化地域"""
         if self._region_map.get(region):
@@ -233,29 +248,6 @@ class Client(Config):
         self._retry = kwargs.get('retry', 1)  # 重试的次数，分片上传时可适当增大
         self._session = kwargs.get('session', session())
 
-    def get_url(self, path='', params=None, **kwargs):
-        """拼接URL
-
-        :param path(str): 请求COS的路径.
-        :param params(str): 请求参数.
-        :param bucket(str): 存储桶名称.
-        :param appid(str): APPID.
-        :param region(str): 存储节点名称.
-        :param scheme(str): 请求协议 http/https.
-        :return(str): 拼接好的URL.
-        """
-
-        result = '{bucket}-{appid}.{region}.myqcloud.com/{path}'.format(
-            bucket=kwargs.get('bucket') or self.bucket,
-            appid=kwargs.get('appid') or self.appid,
-            region=kwargs.get('region') or self.region,
-            path=parse.quote(path, '/-_.~').lstrip('/'))
-        if not kwargs.get('no_scheme'):
-            result = kwargs.get('scheme') or self.scheme + '://' + result
-        if params:
-            result += '?' + parse.urlencode(params or {})
-        return result
-
     def get_auth(self, method, bucket=None, **kwargs):
         """获取签名
 
@@ -301,9 +293,13 @@ class Client(Config):
             raise CosClientError(str(e))
 
         if res.status_code >= 400:  # 所有的4XX,5XX都认为是COSServiceError
-            print(res.headers)
-            print(res.status_code)
-            print(res.text)
+            logger.warning(
+                'cos error response',
+                extra=dict(
+                    url=url,
+                    status_code=res.status_code,
+                    request_id=res.headers.get('x-cos-request-id'),
+                    body=res.text[:512]))
             if method == 'HEAD' and res.status_code == 404:  # Head 需要处理
                 msg = dict(
                     code='NoSuchResource',
@@ -5,6 +5,9 @@ import base64
 import os
 import io
 import re
+import threading
+import time
+from collections import OrderedDict
 
 from xml.dom import minidom
 from xml.etree import ElementTree
@@ -105,3 +108,60 @@ class XMLParser:
         Convert into Dict.
         """
         return dict(self.data)
+
+
+class ExpiringCache:
+    """
+    LRU cache of values which expire at a given time.
+        Expired entries are evicted before the least recently used ones.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, min_ttl=0):
+        """
+        Return the value if it stays valid for min_ttl seconds, or None.
+        """
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expire_at = item
+            if expire_at - now < min_ttl:
+                if expire_at <= now:
+                    del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expire_at):
+        """
+        Keep value until expire_at, a timestamp.
+        """
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            if len(self._data) > self.max_size:
+                self._evict()
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, (_, expire_at) in self._data.items()
+                    if expire_at <= now]:
+            del self._data[key]
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
@@ -9,14 +9,6 @@ from xml.etree.ElementTree import Element, SubElement, tostring
 from .client import Client
 from .exception import CosClientError, CosServiceError
 
-logging.basicConfig(
-    level=logging.INFO,
-    format=
-    '%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-    datefmt='%a, %d %b %Y %H:%M:%S',
-    filename='cos_v5.log',
-    filemode='a')
-
 logger = logging.getLogger(__name__)
 
 
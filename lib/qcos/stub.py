@@ -0,0 +1,337 @@
+# coding=utf-8
+"""A local stand-in of the COS object API.
+
+Objects and multipart uploads are kept in memory. Requests without an
+Authorization header are refused, and error responses can be queued with
+`fail_next` to try the error paths of a client. Point `AsyncClient` at it
+with `endpoint`:
+
+    python -m lib.qcos.stub --port 8900
+
+    bucket = AsyncBucket(..., endpoint='http://127.0.0.1:8900')
+
+`--check` checks the URLs `AsyncBucket` builds for COS, an object round
+trip through a stub on a free port, and resuming a multipart upload of
+`Bucket` from a paginated parts listing, then exits:
+
+    python -m lib.qcos.stub --check
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+from xml.etree.ElementTree import Element, SubElement, fromstring, tostring
+
+from tornado import gen, httpserver, httputil, ioloop, netutil, web
+
+ERROR_BODY = ('<?xml version="1.0" encoding="utf-8" ?><Error>'
+              '<Code>{code}</Code><Message>{message}</Message>'
+              '<Resource>{resource}</Resource><RequestId>stub</RequestId>'
+              '<TraceId>stub</TraceId></Error>')
+
+
+class StubStore:
+    """Objects, uploads and queued failures of a stub server.
+
+    A parts listing returns at most `max_parts` parts, as COS does with
+    1000, so a small value makes clients page through it.
+    """
+
+    def __init__(self, max_parts=1000):
+        self.objects = dict()
+        self.uploads = dict()
+        self.failures = []
+        self.requests = []
+        self.max_parts = max_parts
+
+    def fail_next(self, status, code='InternalError', message='stub'):
+        """Answer the next request with an error."""
+        self.failures.append((status, code, message))
+
+
+def etag(body):
+    """Quoted MD5 of a body, as COS returns it."""
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+class CosHeaders(httputil.HTTPHeaders):
+    """Response headers spelled as COS does, tornado would send Etag."""
+
+    def get_all(self):
+        for name, value in super(CosHeaders, self).get_all():
+            yield 'ETag' if name == 'Etag' else name, value
+
+
+class ObjectHandler(web.RequestHandler):
+    """PUT, GET, HEAD and DELETE of one object, POST ?delete of many.
+
+    With `uploads` or `uploadid` in the query the multipart API instead:
+    create, upload a part, list the parts, complete and abort.
+    """
+
+    def initialize(self, store):
+        self.store = store
+
+    def clear(self):
+        super(ObjectHandler, self).clear()
+        # Bucket reads the ETag of a part from a plain dict of headers.
+        self._headers = CosHeaders(self._headers)
+
+    def prepare(self):
+        self.store.requests.append((self.request.method, self.request.uri))
+        self.set_header('x-cos-request-id', 'stub')
+        self.set_header('x-cos-trace-id', 'stub')
+        if 'Authorization' not in self.request.headers:
+            return self.error(403, 'AccessDenied', 'Missing Authorization')
+        if self.store.failures:
+            return self.error(*self.store.failures.pop(0))
+        # The clients do not agree on the case of the multipart arguments.
+        self.query = {
+            key.lower(): values[-1].decode()
+            for key, values in self.request.query_arguments.items()
+        }
+
+    def error(self, status, code, message):
+        """Finish with a COS error body."""
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/xml')
+        if self.request.method == 'HEAD':
+            return self.finish()
+        self.finish(ERROR_BODY.format(
+            code=code, message=message, resource=self.request.path))
+
+    def xml(self, element):
+        """Finish with an XML body."""
+        self.set_header('Content-Type', 'application/xml')
+        self.finish(tostring(element))
+
+    def upload(self, path):
+        """The upload named by the query, None after an error."""
+        upload = self.store.uploads.get(self.query['uploadid'])
+        if upload is None or upload['key'] != path:
+            return self.error(404, 'NoSuchUpload', 'The upload does not exist')
+        return upload
+
+    def put(self, path):
+        body = self.request.body
+        if 'uploadid' in self.query:
+            upload = self.upload(path)
+            if upload is not None:
+                upload['parts'][int(self.query['partnumber'])] = body
+                self.set_header('ETag', etag(body))
+            return
+        self.store.objects[path] = body
+        self.set_header('ETag', etag(body))
+
+    def get(self, path):
+        if not path and 'uploads' in self.query:
+            return self.list_uploads()
+        if 'uploadid' in self.query:
+            return self.list_parts(path)
+        if path not in self.store.objects:
+            return self.error(404, 'NoSuchKey', 'The key does not exist')
+        self.write(self.store.objects[path])
+
+    def head(self, path):
+        if path not in self.store.objects:
+            return self.error(404, 'NoSuchKey', 'The key does not exist')
+        self.set_header('Content-Length', len(self.store.objects[path]))
+
+    def delete(self, path):
+        if 'uploadid' in self.query:
+            if self.upload(path) is None:
+                return
+            self.store.uploads.pop(self.query['uploadid'])
+        else:
+            self.store.objects.pop(path, None)
+        self.set_status(204)
+
+    def post(self, path):
+        if path and 'uploads' in self.query:
+            return self.create_upload(path)
+        if path and 'uploadid' in self.query:
+            return self.complete_upload(path)
+        if path or 'delete' not in self.query:
+            return self.error(405, 'MethodNotAllowed', 'Not supported')
+        result = Element('DeleteResult')
+        for key in fromstring(self.request.body).iter('Key'):
+            self.store.objects.pop(key.text, None)
+            SubElement(SubElement(result, 'Deleted'), 'Key').text = key.text
+        self.xml(result)
+
+    def create_upload(self, path):
+        upload_id = f'stub-{len(self.store.requests)}'
+        self.store.uploads[upload_id] = dict(
+            key=path, parts=dict(),
+            initiated=time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()))
+        result = Element('InitiateMultipartUploadResult')
+        SubElement(result, 'Key').text = path
+        SubElement(result, 'UploadId').text = upload_id
+        self.xml(result)
+
+    def list_uploads(self):
+        prefix = self.query.get('prefix', '')
+        result = Element('ListMultipartUploadsResult')
+        SubElement(result, 'IsTruncated').text = 'false'
+        for upload_id, upload in self.store.uploads.items():
+            if upload['key'].startswith(prefix):
+                item = SubElement(result, 'Upload')
+                SubElement(item, 'Key').text = parse.quote(upload['key'])
+                SubElement(item, 'UploadId').text = upload_id
+                SubElement(item, 'Initiated').text = upload['initiated']
+        self.xml(result)
+
+    def list_parts(self, path):
+        upload = self.upload(path)
+        if upload is None:
+            return
+        marker = int(self.query.get('part-number-marker') or 0)
+        limit = min(
+            int(self.query.get('max-parts') or 1000), self.store.max_parts)
+        numbers = sorted(n for n in upload['parts'] if n > marker)
+        result = Element('ListPartsResult')
+        SubElement(result, 'Key').text = parse.quote(path)
+        SubElement(result, 'UploadId').text = self.query['uploadid']
+        SubElement(result, 'PartNumberMarker').text = str(marker)
+        if numbers[:limit]:
+            SubElement(result, 'NextPartNumberMarker').text = str(
+                numbers[:limit][-1])
+        SubElement(result, 'MaxParts').text = str(limit)
+        SubElement(result, 'IsTruncated').text = (
+            'true' if len(numbers) > limit else 'false')
+        for number in numbers[:limit]:
+            body = upload['parts'][number]
+            item = SubElement(result, 'Part')
+            SubElement(item, 'PartNumber').text = str(number)
+            SubElement(item, 'ETag').text = etag(body)
+            SubElement(item, 'Size').text = str(len(body))
+        self.xml(result)
+
+    def complete_upload(self, path):
+        upload = self.upload(path)
+        if upload is None:
+            return
+        chunks = []
+        for item in fromstring(self.request.body).iter('Part'):
+            body = upload['parts'].get(int(item.findtext('PartNumber')))
+            if body is None or etag(body) != item.findtext('ETag'):
+                return self.error(400, 'InvalidPart', 'A part does not match')
+            chunks.append(body)
+        body = self.store.objects[path] = b''.join(chunks)
+        self.store.uploads.pop(self.query['uploadid'])
+        result = Element('CompleteMultipartUploadResult')
+        SubElement(result, 'Key').text = path
+        SubElement(result, 'ETag').text = etag(body)
+        self.xml(result)
+
+
+def make_app(store=None):
+    """Create the stub application, objects are kept in `store`."""
+    store = store or StubStore()
+    app = web.Application([(r'/(.*)', ObjectHandler, dict(store=store))])
+    app.store = store
+    return app
+
+
+def check():
+    """检查 AsyncBucket 拼接的 COS URL, 经过 stub 的上传下载删除, 以及
+    Bucket 从分页的分块列表续传分块上传"""
+    from .async_client import AsyncBucket
+
+    options = dict(bucket='lazor', appid='1250000000', region='cossh',
+                   access_id='id', access_key='key')
+    bucket = AsyncBucket(**options)
+    url = bucket.get_url(bucket=None, path='/image/x.jpg')
+    assert url == ('https://lazor-1250000000.cos.ap-shanghai.myqcloud.com'
+                   '/image/x.jpg'), url
+    url = bucket.get_url(bucket=None) + '?delete'
+    assert url == ('https://lazor-1250000000.cos.ap-shanghai.myqcloud.com'
+                   '/?delete'), url
+
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    store = StubStore(max_parts=2)
+    server = httpserver.HTTPServer(make_app(store))
+    server.add_sockets(sockets)
+    bucket = AsyncBucket(endpoint=f'http://127.0.0.1:{port}', **options)
+    executor = ThreadPoolExecutor(1)
+
+    @gen.coroutine
+    def round_trip():
+        """Put, get, head and delete one object, then resume an upload."""
+        yield bucket.put_object(body=b'stub', path='/image/x.jpg')
+        res = yield bucket.get_object(path='/image/x.jpg')
+        assert res['body'] == b'stub', res
+        yield bucket.head_object(path='/image/x.jpg')
+        yield bucket.delete_objects(['image/x.jpg'], quiet='true')
+        yield executor.submit(resume, store, port, options)
+
+    try:
+        ioloop.IOLoop.current().run_sync(round_trip)
+    finally:
+        bucket.close()
+        executor.shutdown()
+        server.stop()
+    print('ok')
+
+
+def resume(store, port, options):
+    """Resume an upload of 13 parts, 5 of them done, one of those short.
+
+    Runs in a thread, `Bucket` blocks. The stub lists 2 parts at a time.
+    """
+    from requests import Session
+    from .bucket import Bucket
+
+    class StubSession(Session):
+        """Send the requests for COS to the stub."""
+
+        def request(self, method, url, *args, **kwargs):
+            url = parse.urlsplit(url)._replace(
+                scheme='http', netloc=f'127.0.0.1:{port}').geturl()
+            return super().request(method, url, *args, **kwargs)
+
+    bucket = Bucket(session=StubSession(), **options)
+    part_size = 1024 * 1024
+    with tempfile.NamedTemporaryFile() as fp:
+        data = os.urandom(part_size * 12 + 123)
+        fp.write(data)
+        fp.flush()
+
+        upload_id = bucket.create_group(path='/video/x.mp4')['body'][
+            'UploadId']
+        for part in (1, 2, 3, 5, 7):
+            body = data[part_size * (part - 1):part_size * part]
+            bucket.upload_part(
+                path='/video/x.mp4', body=body[:10] if part == 3 else body,
+                part=part, upload_id=upload_id)
+
+        del store.requests[:]
+        bucket.upload_file('/video/x.mp4', fp.name, part_size=1, resume=True)
+        assert store.objects['video/x.mp4'] == data
+        assert not store.uploads, store.uploads
+        sent = [uri for method, uri in store.requests if method == 'PUT']
+        assert len(sent) == 9, sent  # parts 3, 4, 6 and 8 to 13
+        listed = [uri for method, uri in store.requests
+                  if method == 'GET' and 'uploadid' in uri]
+        assert len(listed) == 3, listed  # 5 parts, 2 a page
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--check', action='store_true',
+                        help='check the client against a stub and exit')
+    args = parser.parse_args()
+    if args.check:
+        return check()
+    make_app().listen(args.port, '127.0.0.1')
+    ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 # coding:utf-8
 """Module of models"""
 
-from models.lazor_mongo import M_CLIENT as m_client, Mongo
+from models.lazor_mongo import M_CLIENT as m_client, Mongo, AsyncCollection
 
 from models.lazor_models import BASE, User, Article, Category
@@ -0,0 +1,209 @@
+# coding:utf-8
+"""Module of the buffered access log.
+
+Entries are kept in memory and written with `insert_many`, once
+`access_log.batch_size` of them are waiting or `access_log.flush_interval`
+seconds after the first one. Only one write is in flight at a time; while
+it runs new entries wait in the buffer, and once the buffer holds
+`access_log.max_size` entries new ones are dropped and counted in
+`dropped`.
+
+An `_id` in an entry is never written, every insert gets fresh ones. When
+an insert fails, only the entries it did not write go back to the buffer,
+and entries rejected as duplicates are dropped. Entries which still fail
+after `access_log.max_retries` writes in a row are dropped too, so one
+bad entry cannot hold up the others.
+
+Each written batch is also counted in the rollups, if one is given.
+"""
+
+import logging
+from collections import deque
+
+from pymongo.errors import BulkWriteError
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from config import CFG as config
+from models.access_rollup import ACCESS_ROLLUP
+from models.lazor_mongo import Mongo
+from utils.metrics import Gauge
+from utils.prefork import on_fork, on_shutdown
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class AccessLogBuffer:
+    """Buffer of access log entries written to a Mongo collection."""
+
+    def __init__(self, collection, max_size=10000, batch_size=500,
+                 flush_interval=1, rollup=None, max_retries=3):
+        self.collection = collection
+        self.rollup = rollup
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.dropped = 0
+        self._failures = 0
+        self._entries = deque()
+        self._flushing = False
+        self._timeout = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, entry):
+        """Queue an entry, return False if it was dropped."""
+        if len(self._entries) >= self.max_size:
+            self.dropped += 1
+            return False
+
+        self._entries.append(entry)
+        if len(self._entries) >= self.batch_size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = IOLoop.current().call_later(
+                self.flush_interval, self._on_timeout)
+        return True
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.flush()
+
+    def _take(self):
+        """Pop a batch from the front of the buffer."""
+        count = min(self.batch_size, len(self._entries))
+        return [self._entries.popleft() for _ in range(count)]
+
+    def _restore(self, batch):
+        """Put a failed batch back to the front, as far as there is room."""
+        room = max(self.max_size - len(self._entries), 0)
+        self.dropped += max(len(batch) - room, 0)
+        self._entries.extendleft(reversed(batch[:room]))
+
+    def _insert(self, batch):
+        """Insert copies of the entries without `_id`, return a future.
+
+        insert_many sets `_id` on the documents it is given, the entries
+        themselves are kept as they were so a retry gets fresh ones.
+        """
+        return self.collection.insert_many(
+            [{key: value for key, value in entry.items() if key != '_id'}
+             for entry in batch],
+            ordered=False)
+
+    def _split(self, batch, error):
+        """Split a batch whose insert failed into written and retryable.
+
+        Entries rejected as duplicates are neither, they are dropped. Any
+        error other than BulkWriteError leaves the whole batch unwritten.
+        """
+        if not isinstance(error, BulkWriteError):
+            return [], batch
+        codes = {
+            write_error['index']: write_error.get('code')
+            for write_error in error.details.get('writeErrors', [])
+        }
+        written = [
+            entry for index, entry in enumerate(batch) if index not in codes
+        ]
+        retry = [
+            batch[index] for index, code in sorted(codes.items())
+            if code != DUPLICATE_KEY
+        ]
+        self.dropped += len(codes) - len(retry)
+        return written, retry
+
+    @coroutine
+    def _count(self, batch):
+        """Add a written batch to the rollups, a failure only loses counts."""
+        if self.rollup is None or not batch:
+            return
+        try:
+            yield self.rollup.add(batch)
+        except Exception:
+            logger.exception('rollup of %d log entries failed', len(batch))
+
+    @coroutine
+    def flush(self):
+        """Write the buffered entries, a batch at a time."""
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._entries:
+                batch = self._take()
+                try:
+                    yield self._insert(batch)
+                except Exception as error:
+                    written, retry = self._split(batch, error)
+                    self._failures += 1
+                    logger.exception('insert of %d log entries failed, '
+                                     '%d written', len(batch), len(written))
+                    if self._failures >= self.max_retries:
+                        self.dropped += len(retry)
+                    else:
+                        self._restore(retry)
+                    yield self._count(written)
+                    break
+                self._failures = 0
+                yield self._count(batch)
+        finally:
+            self._flushing = False
+
+        if self._entries and self._timeout is None:
+            self._timeout = IOLoop.current().call_later(
+                self.flush_interval, self._on_timeout)
+
+    def close(self, timeout=5):
+        """Write everything left, blocking until done.
+
+        A failed batch is dropped and the next one still written.
+        """
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        while self._entries:
+            batch = written = self._take()
+            try:
+                self._insert(batch).result(timeout)
+            except Exception as error:
+                written, retry = self._split(batch, error)
+                self.dropped += len(retry)
+                logger.exception('insert of %d log entries failed, '
+                                 '%d written', len(batch), len(written))
+            if self.rollup is None or not written:
+                continue
+            try:
+                self.rollup.add(written).result(timeout)
+            except Exception:
+                logger.exception('rollup of %d log entries failed',
+                                 len(written))
+
+    def reset(self):
+        """Drop buffered entries and counters."""
+        self._entries.clear()
+        self._flushing = False
+        self._timeout = None
+        self.dropped = 0
+        self._failures = 0
+
+
+ACCESS_LOG = AccessLogBuffer(
+    Mongo.access_log,
+    max_size=config.get('access_log.max_size', 10000),
+    batch_size=config.get('access_log.batch_size', 500),
+    flush_interval=config.get('access_log.flush_interval', 1),
+    rollup=ACCESS_ROLLUP,
+    max_retries=config.get('access_log.max_retries', 3))
+
+Gauge('access_log_buffered', 'Access log entries waiting to be written.',
+      function=lambda: len(ACCESS_LOG))
+Gauge('access_log_dropped', 'Access log entries never written.',
+      function=lambda: ACCESS_LOG.dropped)
+
+on_fork(ACCESS_LOG.reset)
+on_shutdown(ACCESS_LOG.close)
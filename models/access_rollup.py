@@ -0,0 +1,90 @@
+# coding:utf-8
+"""Module of access log rollups.
+
+Counters per page, per user and in total, by hour, are kept in the
+`access_rollup` collection as documents of `kind`, `key`, `hour` (the
+timestamp the hour starts at) and `count`. They are incremented from each
+batch the access log writes, so stats never scan `access_log`.
+"""
+
+from collections import Counter
+
+from pymongo import UpdateOne
+from tornado.gen import coroutine
+
+from models.lazor_mongo import Mongo
+
+KINDS = ('page', 'user', 'hour')
+
+
+def hour_of(timestamp):
+    """Timestamp of the start of the hour."""
+    timestamp = int(timestamp)
+    return timestamp - timestamp % 3600
+
+
+def count_entries(entries):
+    """Count access log entries by (kind, key, hour)."""
+    counts = Counter()
+    for entry in entries:
+        hour = hour_of(entry.get('time', 0))
+        counts[('page', str(entry.get('page')), hour)] += 1
+        counts[('user', entry.get('user_id') or 'anonymous', hour)] += 1
+        counts[('hour', '', hour)] += 1
+    return counts
+
+
+class AccessRollup:
+    """Rollup counters kept in a Mongo collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def add(self, entries):
+        """Count a batch of entries, return a future of the bulk write."""
+        return self.collection.bulk_write(
+            [
+                UpdateOne(
+                    dict(kind=kind, key=key, hour=hour),
+                    {'$inc': dict(count=count)},
+                    upsert=True)
+                for (kind, key, hour), count in count_entries(entries).items()
+            ],
+            ordered=False)
+
+    @coroutine
+    def stats(self, kind, since=None, until=None, keys=None, limit=20):
+        """Sum the counters of a kind between two timestamps.
+
+        :param kind: 'page' or 'user' for the top keys by count, 'hour' for
+            the total of each hour.
+        :param keys: only count these keys.
+        :return: a list of dicts of `key` (or `hour`) and `count`; for
+            'hour' the latest `limit` hours, oldest first.
+        """
+        match = dict(kind=kind)
+        if since is not None or until is not None:
+            match['hour'] = dict()
+            if since is not None:
+                match['hour']['$gte'] = hour_of(since)
+            if until is not None:
+                match['hour']['$lte'] = int(until)
+        if keys:
+            match['key'] = {'$in': list(keys)}
+
+        group_by = 'hour' if kind == 'hour' else 'key'
+        sort = {'_id': -1} if kind == 'hour' else {'count': -1, '_id': 1}
+        result = yield self.collection.aggregate([
+            {'$match': match},
+            {'$group': {'_id': f'${group_by}', 'count': {'$sum': '$count'}}},
+            {'$sort': sort},
+            {'$limit': limit},
+        ]).to_list()
+        if kind == 'hour':
+            result.reverse()
+
+        return [{group_by: item['_id'], 'count': item['count']}
+                for item in result]
+
+
+ACCESS_ROLLUP = AccessRollup(Mongo.access_rollup)
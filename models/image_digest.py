@@ -0,0 +1,92 @@
+# coding:utf-8
+"""Module of the digests of uploaded images.
+
+Images are addressed by the md5 and sha1 of their content, unique together
+in the `image` collection. `IMAGE_DIGESTS` is a bloom filter of the digests
+known to this process, loaded from the collection on first use, so content
+never seen before is not looked up in Mongo.
+
+Digests stored by another worker after the load are not in the filter.
+Such an upload is stored again and its insert fails on the unique index,
+see `DuplicateKeyError` in views/file.py.
+"""
+
+import logging
+
+from tornado.ioloop import IOLoop
+
+from models.lazor_mongo import Mongo
+from utils import O_O
+from utils.bloom import BloomFilter
+from utils.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+DIGEST_LOOKUPS = Counter(
+    'image_digest_lookups_total', 'Digest checks of uploaded images.',
+    labels=('result', ))
+
+
+def digest_key(md5_code, sha1_code):
+    """Key of a digest in the filter."""
+    return bytes.fromhex(md5_code) + bytes.fromhex(sha1_code)
+
+
+class ImageDigests:
+    """Bloom filter of the digests in an image collection."""
+
+    def __init__(self, collection, capacity=100000, error_rate=0.01):
+        self.collection = collection
+        self.filter = BloomFilter(capacity, error_rate)
+        self.loading = None
+        self.ready = False
+
+    def load(self):
+        """Load the digests in the collection, return a future.
+
+        The filter is filled on the IO loop, which also adds to it, not on
+        the thread running the query.
+        """
+        future = self.collection.find(
+            {}, projection={'_id': 0, 'md5_code': 1, 'sha1_code': 1}
+        ).to_list()
+
+        def done(future):
+            """Fill the filter, or retry the load on the next use."""
+            if future.exception() is not None:
+                logger.warning('loading image digests failed: %r',
+                               future.exception())
+                self.loading = None
+                return
+            for image in future.result():
+                if image.get('md5_code') and image.get('sha1_code'):
+                    self.add(image['md5_code'], image['sha1_code'])
+            self.ready = True
+            logger.info('%s image digests loaded', self.filter.count)
+
+        self.loading = future
+        IOLoop.current().add_future(future, done)
+        return future
+
+    def might_exist(self, md5_code, sha1_code):
+        """False only if no image has this content, True if it may."""
+        if not self.ready:
+            if self.loading is None:
+                self.load()
+            DIGEST_LOOKUPS.inc(result='loading')
+            return True
+        if digest_key(md5_code, sha1_code) in self.filter:
+            DIGEST_LOOKUPS.inc(result='maybe')
+            return True
+        DIGEST_LOOKUPS.inc(result='new')
+        return False
+
+    def add(self, md5_code, sha1_code):
+        """Record the digest of a stored image."""
+        self.filter.add(digest_key(md5_code, sha1_code))
+
+
+IMAGE_DIGESTS = ImageDigests(
+    Mongo.image,
+    O_O.get('image_dedup.bloom_capacity', 100000),
+    O_O.get('image_dedup.bloom_error_rate', 0.01))
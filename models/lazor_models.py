@@ -1,8 +1,8 @@
 # coding:utf-8
 """Lazor Database Module."""
 
-from sqlalchemy import (CHAR, Column, Enum, Integer, SmallInteger, String,
-                        Text, UniqueConstraint)
+from sqlalchemy import (CHAR, Column, Enum, Index, Integer, SmallInteger,
+                        String, Text, UniqueConstraint)
 
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -37,7 +37,7 @@ class Article(BASE):
     __tablename__ = 'article'
 
     article_id = Column(CHAR(36), primary_key=True)
-    category_id = Column(CHAR(36), default='default', index=True)
+    category_id = Column(CHAR(36), default='default')
     user_id = Column(CHAR(36), nullable=False, index=True)
     title = Column(String(255), nullable=False)
     content = Column(Text, nullable=False)
@@ -45,7 +45,11 @@ class Article(BASE):
     update_time = Column(Integer, nullable=False, index=True)
     create_time = Column(Integer, nullable=False, index=True)
 
-    __table_args__ = ({'mysql_engine': 'InnoDB'}, )
+    __table_args__ = (
+        # Keyset pagination of a category's articles.
+        Index('ix_article_category_id_create_time',
+              'category_id', 'create_time', 'article_id'),
+        {'mysql_engine': 'InnoDB'}, )
 
 
 class Category(BASE):
@@ -53,13 +57,16 @@ class Category(BASE):
     __tablename__ = 'category'
 
     category_id = Column(CHAR(36), primary_key=True)
-    user_id = Column(CHAR(36), nullable=False, index=True)
+    user_id = Column(CHAR(36), nullable=False)
     category_name = Column(String(255), nullable=False)
     category_type = Column(SmallInteger, nullable=False)
     category_order = Column(SmallInteger, nullable=False)
     create_time = Column(Integer, nullable=False, index=True)
 
-    __table_args__ = ({'mysql_engine': 'InnoDB'}, )
+    __table_args__ = (
+        Index('ix_category_user_id_category_type',
+              'user_id', 'category_type'),
+        {'mysql_engine': 'InnoDB'}, )
 
 
 class Image(BASE):
@@ -1,11 +1,116 @@
 # coding:utf-8
 """Predefination of mongo schema."""
 
-from pymongo import MongoClient
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from itertools import islice
+
+from pymongo import MongoClient, monitoring
+from pymongo.errors import OperationFailure
 
 from config import CFG as config
+from utils.metrics import Counter, Gauge, Histogram
+from utils.prefork import on_fork
+
+logger = logging.getLogger(__name__)
+
+MONGO_COMMAND_LATENCY = Histogram(
+    'mongo_command_seconds', 'Run time of a Mongo command.',
+    labels=('command', 'collection'))
+MONGO_COMMAND_ERRORS = Counter(
+    'mongo_command_errors_total', 'Mongo commands that failed.',
+    labels=('command', 'collection'))
+MONGO_POOL_WAIT = Histogram(
+    'mongo_pool_checkout_seconds', 'Time to get a connection from the pool.')
+MONGO_POOL_CHECKED_OUT = Gauge(
+    'mongo_pool_checked_out', 'Connections in use.')
+MONGO_POOL_FAILURES = Counter(
+    'mongo_pool_checkout_failures_total', 'Checkouts that failed.',
+    labels=('reason', ))
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Record the latency of Mongo commands per collection."""
+
+    def __init__(self):
+        self._collections = dict()
+
+    def started(self, event):
+        # The collection is only in the command, remember it for the reply.
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ''
+        self._collections[event.request_id] = collection
+
+    def succeeded(self, event):
+        collection = self._collections.pop(event.request_id, '')
+        MONGO_COMMAND_LATENCY.observe(
+            event.duration_micros / 1e6,
+            command=event.command_name, collection=collection)
+
+    def failed(self, event):
+        collection = self._collections.pop(event.request_id, '')
+        MONGO_COMMAND_LATENCY.observe(
+            event.duration_micros / 1e6,
+            command=event.command_name, collection=collection)
+        MONGO_COMMAND_ERRORS.inc(
+            command=event.command_name, collection=collection)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Record checkout waits and connections in use.
+
+    A checkout runs in one thread from start to end, so the start time is
+    kept in a thread local.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        MONGO_POOL_WAIT.observe(
+            time.perf_counter() - getattr(self._local, 'start', 0))
+        MONGO_POOL_CHECKED_OUT.inc()
 
-M_CLIENT = MongoClient(config.mongo.client).__getattr__(config.mongo.db)
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_FAILURES.inc(reason=event.reason)
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CHECKED_OUT.dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+def _create_client():
+    return MongoClient(
+        config.mongo.client,
+        event_listeners=[CommandMetrics(), PoolMetrics()],
+    ).__getattr__(config.mongo.db)
+
+
+M_CLIENT = _create_client()
 
 SESSION = M_CLIENT.session
 
@@ -20,18 +125,143 @@ ARTICLE_ORDER.create_index('category_id')
 
 IMAGE = M_CLIENT.image
 IMAGE.create_index('image_id')
-IMAGE.create_index('md5_code')
 IMAGE.create_index('user_id')
+try:
+    IMAGE.create_index([('md5_code', 1), ('sha1_code', 1)], unique=True)
+except OperationFailure:
+    # Duplicates stored before the index existed, dedup still works,
+    # concurrent uploads of the same content may store it twice.
+    logger.exception('unique digest index of image not created, '
+                     'remove duplicate md5_code and sha1_code first')
+    IMAGE.create_index('md5_code')
+else:
+    # Covered by the unique index.
+    if 'md5_code_1' in IMAGE.index_information():
+        IMAGE.drop_index('md5_code_1')
+
+ACCESS_ROLLUP = M_CLIENT.access_rollup
+ACCESS_ROLLUP.create_index([('kind', 1), ('key', 1), ('hour', 1)],
+                           unique=True)
+ACCESS_ROLLUP.create_index([('kind', 1), ('hour', 1)])
+
+
+def _create_executor():
+    return ThreadPoolExecutor(max_workers=config.get('mongo.max_workers', 10))
+
+
+MONGO_EXECUTOR = _create_executor()
+
+Gauge('mongo_executor_queue', 'Mongo calls waiting for an executor thread.',
+      function=lambda: MONGO_EXECUTOR._work_queue.qsize())
+
+
+class AsyncCursor:
+    """Cursor returned by `AsyncCollection.find`."""
+
+    method = 'find'
+
+    def __init__(self, collection, *args, **kwargs):
+        self.collection = collection
+        self.args = args
+        self.kwargs = kwargs
+        self.trace = None
+
+    def _submit(self, fetch):
+        future = MONGO_EXECUTOR.submit(fetch)
+        if self.trace is not None:
+            self.trace.track(
+                f'mongo {self.collection.name}.{self.method}', future)
+        return future
+
+    def to_list(self, length=None):
+        """Fetch the documents on the executor, return a future of a list."""
+
+        def fetch():
+            """Iterate the cursor."""
+            cursor = self.collection.find(*self.args, **self.kwargs)
+            if length:
+                cursor = cursor.limit(length)
+            return list(cursor)
+
+        return self._submit(fetch)
+
+
+class AsyncCommandCursor(AsyncCursor):
+    """Cursor returned by `AsyncCollection.aggregate`."""
+
+    method = 'aggregate'
+
+    def to_list(self, length=None):
+        """Fetch the documents on the executor, return a future of a list."""
+
+        def fetch():
+            """Iterate the cursor."""
+            cursor = self.collection.aggregate(*self.args, **self.kwargs)
+            with cursor:
+                return list(islice(cursor, length))
+
+        return self._submit(fetch)
+
+
+class AsyncCollection:
+    """Executor-backed proxy of a pymongo collection.
+
+    Methods are the pymongo ones, but return a future which can be yielded
+    from a tornado coroutine. `find` and `aggregate` return a cursor with
+    `to_list` instead, like motor does. The blocking collection is kept as
+    `delegate`.
+
+    Read from a handler with a `trace`, as the `Mongo` mixin attributes
+    are, every call is recorded as a span of that trace.
+    """
+
+    def __init__(self, delegate, trace=None):
+        self.delegate = delegate
+        self.trace = trace
+
+    def __get__(self, instance, owner):
+        trace = getattr(instance, 'trace', None)
+        if trace is None:
+            return self
+        return AsyncCollection(self.delegate, trace)
+
+    def __getattr__(self, name):
+        attr = getattr(self.delegate, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def method(*args, **kwargs):
+            """Run the pymongo method on the executor."""
+            future = MONGO_EXECUTOR.submit(attr, *args, **kwargs)
+            if self.trace is not None:
+                self.trace.track(f'mongo {self.delegate.name}.{name}', future)
+            return future
+
+        return method
+
+    def find(self, *args, **kwargs):
+        """Query the collection, return an `AsyncCursor`."""
+        cursor = AsyncCursor(self.delegate, *args, **kwargs)
+        cursor.trace = self.trace
+        return cursor
+
+    def aggregate(self, *args, **kwargs):
+        """Run an aggregation, return an `AsyncCommandCursor`."""
+        cursor = AsyncCommandCursor(self.delegate, *args, **kwargs)
+        cursor.trace = self.trace
+        return cursor
 
 
 class Mongo:
     """Mongo Client Set."""
-    session = M_CLIENT.session
-    category_order = M_CLIENT.category_order
-    article_order = M_CLIENT.article_order
-    article_content = M_CLIENT.article_content
-    image = M_CLIENT.image
-    access_log = M_CLIENT.access_log
+    session = AsyncCollection(M_CLIENT.session)
+    category_order = AsyncCollection(M_CLIENT.category_order)
+    article_order = AsyncCollection(M_CLIENT.article_order)
+    article_content = AsyncCollection(M_CLIENT.article_content)
+    image = AsyncCollection(M_CLIENT.image)
+    access_log = AsyncCollection(M_CLIENT.access_log)
+    access_rollup = AsyncCollection(M_CLIENT.access_rollup)
 
     @staticmethod
     def laugh():
@@ -42,3 +272,17 @@ class Mongo:
     def cry():
         """fill method."""
         print('55555555555555555')
+
+
+@on_fork
+def reset_client():
+    """Re-create the client and the executor in a forked worker.
+
+    MongoClient is not fork-safe, so every worker needs its own.
+    """
+    global M_CLIENT, MONGO_EXECUTOR
+    M_CLIENT = _create_client()
+    MONGO_EXECUTOR = _create_executor()
+    for name, collection in vars(Mongo).items():
+        if isinstance(collection, AsyncCollection):
+            collection.delegate = M_CLIENT[name]
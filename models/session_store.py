@@ -0,0 +1,195 @@
+# coding:utf-8
+"""Module of the session store.
+
+Sessions are keyed by the client ip. Reads go through an in-process cache,
+and updates are written behind: updates to the same ip are merged and
+written in one bulk write every `session.flush_interval` seconds, unless
+`flush=True` is given.
+
+Every worker process has its own cache, so a value checked against what
+another worker wrote (like `mixin`) should be re-read with `fresh=True`
+before it is rejected.
+"""
+
+import copy
+import logging
+
+from pymongo import UpdateOne
+from tornado.concurrent import Future
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from config import CFG as config
+from models.lazor_mongo import Mongo
+from utils.cache import LRUCache
+from utils.prefork import on_fork, on_shutdown
+
+logger = logging.getLogger(__name__)
+
+
+def _done(value=None):
+    """Return a future resolved with value."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class SessionStore:
+    """Base of session stores, subclasses implement `_load` and `_write`.
+
+    `_load(ip)` returns a future of the session dict, None if missing.
+    `_write(batch)` returns a future, batch maps an ip to a tuple of
+    (fields to set, upsert).
+    """
+
+    def __init__(self, flush_interval=1, cache_ttl=60,
+                 cache_max_bytes=8 * 1024 * 1024):
+        self.flush_interval = flush_interval
+        self.cache = LRUCache(max_bytes=cache_max_bytes, ttl=cache_ttl)
+        self._dirty = dict()
+        self._timeout = None
+
+    def _load(self, ip):
+        raise NotImplementedError()
+
+    def _write(self, batch):
+        raise NotImplementedError()
+
+    @coroutine
+    def get(self, ip, fresh=False):
+        """Get the session of an ip, None if there is none.
+
+        :param fresh: skip the cache and read from the backend.
+        """
+        if not fresh:
+            entry = self.cache.get_entry(ip)
+            if entry is not None:
+                return entry.value
+
+        session = yield self._load(ip)
+        if ip in self._dirty:
+            fields, upsert = self._dirty[ip]
+            if session is not None or upsert:
+                session = dict(session or dict(ip=ip), **fields)
+        if session is not None:
+            session.pop('_id', None)
+            self.cache.set(ip, session)
+        return session
+
+    def update(self, ip, fields, upsert=False, flush=False):
+        """Set fields of the session of an ip.
+
+        Return a future, resolved at once unless `flush` is True, then it
+        is resolved after all pending updates are written.
+        """
+        cached = self.cache.get(ip)
+        if cached is not None:
+            if all(cached.get(key) == value for key, value in fields.items()):
+                return self.flush() if flush else _done()
+            self.cache.set(ip, dict(cached, **fields))
+
+        pending_fields, pending_upsert = self._dirty.get(ip, (dict(), False))
+        self._dirty[ip] = (dict(pending_fields, **fields),
+                           pending_upsert or upsert)
+
+        if flush:
+            return self.flush()
+        if self._timeout is None:
+            self._timeout = IOLoop.current().call_later(
+                self.flush_interval, self._on_timeout)
+        return _done()
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.flush()
+
+    @coroutine
+    def flush(self):
+        """Write all pending updates in one batch."""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, dict()
+        try:
+            yield self._write(batch)
+        except Exception:
+            logger.exception('flush of %d sessions failed', len(batch))
+            # Keep them for the next flush, newer updates win.
+            for ip, (fields, upsert) in batch.items():
+                newer_fields, newer_upsert = self._dirty.get(
+                    ip, (dict(), False))
+                self._dirty[ip] = (dict(fields, **newer_fields),
+                                   upsert or newer_upsert)
+            if self._timeout is None:
+                self._timeout = IOLoop.current().call_later(
+                    self.flush_interval, self._on_timeout)
+
+    def close(self, timeout=5):
+        """Write pending updates, blocking until done."""
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        batch, self._dirty = self._dirty, dict()
+        if batch:
+            self._write(batch).result(timeout)
+
+    def reset(self):
+        """Drop the cache and pending updates."""
+        self.cache.clear()
+        self._dirty = dict()
+        self._timeout = None
+
+
+class MongoSessionStore(SessionStore):
+    """Session store backed by a Mongo collection."""
+
+    def __init__(self, collection, **kwargs):
+        super(MongoSessionStore, self).__init__(**kwargs)
+        self.collection = collection
+
+    def _load(self, ip):
+        return self.collection.find_one({'ip': ip})
+
+    def _write(self, batch):
+        return self.collection.bulk_write(
+            [
+                UpdateOne({'ip': ip}, {'$set': fields}, upsert=upsert)
+                for ip, (fields, upsert) in batch.items()
+            ],
+            ordered=False)
+
+
+class MemorySessionStore(SessionStore):
+    """Session store kept in memory, for tests and local runs."""
+
+    def __init__(self, **kwargs):
+        super(MemorySessionStore, self).__init__(**kwargs)
+        self.sessions = dict()
+
+    def _load(self, ip):
+        return _done(copy.deepcopy(self.sessions.get(ip)))
+
+    def _write(self, batch):
+        for ip, (fields, upsert) in batch.items():
+            if ip in self.sessions:
+                self.sessions[ip].update(copy.deepcopy(fields))
+            elif upsert:
+                self.sessions[ip] = dict(ip=ip, **copy.deepcopy(fields))
+        return _done()
+
+
+def create_session_store():
+    """Create the session store chosen by the `session.backend` option."""
+    options = dict(
+        flush_interval=config.get('session.flush_interval', 1),
+        cache_ttl=config.get('session.cache_ttl', 60),
+        cache_max_bytes=config.get('session.cache_max_bytes',
+                                   8 * 1024 * 1024))
+    if config.get('session.backend', 'mongo') == 'memory':
+        return MemorySessionStore(**options)
+    return MongoSessionStore(Mongo.session, **options)
+
+
+SESSION_STORE = create_session_store()
+
+on_fork(SESSION_STORE.reset)
+on_shutdown(SESSION_STORE.close)
@@ -0,0 +1,145 @@
+# coding:utf-8
+"""Module of the static asset handler."""
+
+import os
+
+from tornado import gen, httputil, iostream
+from tornado.web import StaticFileHandler
+
+from config import CFG as config
+from utils import compress
+from utils.cache import FILE_CACHE
+
+
+class StaticAssetHandler(StaticFileHandler):
+    """Serve files from a directory.
+
+    Large files are streamed in chunks, so a request never holds a whole
+    file in memory. Files up to `static.max_cached_size` bytes are kept in
+    `FILE_CACHE`, keyed by path, mtime and size, so a change on disk is
+    picked up by the next request; their compressed bodies are cached too.
+    Range, If-None-Match and If-Modified-Since requests are supported, and
+    ETags come from the stat result instead of hashing the content.
+    """
+
+    max_cached_size = config.get('static.max_cached_size', 256 * 1024)
+
+    def initialize(self, path, default_filename=None, max_age=0):
+        """Set the root directory and the Cache-Control max-age."""
+        super(StaticAssetHandler, self).initialize(path, default_filename)
+        self.max_age = max_age
+        self.encoding = None
+
+    @gen.coroutine
+    def get(self, path, include_body=True):
+        self.path = self.parse_url_path(path)
+        del path
+        absolute_path = self.get_absolute_path(self.root, self.path)
+        self.absolute_path = self.validate_absolute_path(
+            self.root, absolute_path)
+        if self.absolute_path is None:
+            return
+
+        entry = self.get_cached_entry()
+        self.encoding = self.get_encoding(entry)
+
+        self.modified = self.get_modified_time()
+        self.set_headers()
+
+        if self.should_return_304():
+            self.set_status(304)
+            return
+
+        if self.encoding:
+            body = entry.variant(
+                self.encoding,
+                lambda: compress.compress(entry.value, self.encoding))
+            self.set_header('Content-Encoding', self.encoding)
+            self.set_header('Content-Length', len(body))
+            if include_body:
+                self.write(body)
+            return
+
+        request_range = None
+        range_header = self.request.headers.get('Range')
+        if range_header:
+            request_range = httputil._parse_request_range(range_header)
+
+        size = self.get_content_size()
+        start = end = None
+        if request_range:
+            start, end = request_range
+            if (start is not None and start >= size) or end == 0:
+                self.set_status(416)
+                self.set_header('Content-Type', 'text/plain')
+                self.set_header('Content-Range', f'bytes */{size}')
+                return
+            if start is not None and start < 0:
+                start += size
+            if end is not None and end > size:
+                end = size
+            if size != (end or size) - (start or 0):
+                self.set_status(206)
+                self.set_header('Content-Range',
+                                httputil._get_content_range(start, end, size))
+
+        self.set_header('Content-Length', (end or size) - (start or 0))
+
+        if not include_body:
+            return
+
+        if entry is not None:
+            self.write(entry.value[start:end])
+            return
+
+        for chunk in self.get_content(self.absolute_path, start, end):
+            try:
+                self.write(chunk)
+                yield self.flush()
+            except iostream.StreamClosedError:
+                return
+
+    def get_cached_entry(self):
+        """Get the cache entry of a small file, None for large ones."""
+        stat_result = self._stat()
+        if stat_result.st_size > self.max_cached_size:
+            return None
+
+        key = (self.absolute_path, stat_result.st_mtime, stat_result.st_size)
+        entry = FILE_CACHE.get_entry(key)
+        if entry is None:
+            with open(self.absolute_path, 'rb') as static_file:
+                entry = FILE_CACHE.set(
+                    key, static_file.read(), etag=self.compute_etag())
+        return entry
+
+    def get_encoding(self, entry):
+        """Pick the content encoding, only whole cached files are encoded."""
+        if entry is None or 'Range' in self.request.headers:
+            return None
+        if not compress.is_compressible(self.get_content_type(),
+                                        len(entry.value)):
+            return None
+        self.set_header('Vary', 'Accept-Encoding')
+        return compress.accepted_encoding(
+            self.request.headers.get('Accept-Encoding', ''))
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        """Version from mtime and size, the content is never read."""
+        stat_result = os.stat(abspath)
+        return f'{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}'
+
+    def compute_etag(self):
+        stat_result = self._stat()
+        version = f'{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}'
+        if self.encoding:
+            return f'"{version}-{self.encoding}"'
+        return f'"{version}"'
+
+    def get_cache_time(self, path, modified, mime_type):
+        return self.max_age
+
+    def set_extra_headers(self, path):
+        if not self.max_age:
+            self.set_header('Cache-Control', 'no-cache')
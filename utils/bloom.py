@@ -0,0 +1,37 @@
+# coding:utf-8
+"""Module of a bloom filter of digests."""
+
+import math
+
+
+class BloomFilter:
+    """Set of keys which may answer "maybe" for a key never added.
+
+    Sized for `capacity` keys at a false positive rate of `error_rate`,
+    more keys raise the rate. Keys are digests, uniform already, so the
+    bit positions are taken from the key itself by double hashing instead
+    of hashing it again.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) /
+                               math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        first = int.from_bytes(key[:8], 'big')
+        second = int.from_bytes(key[8:16], 'big') | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key):
+        """Add a key of at least 16 bytes."""
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
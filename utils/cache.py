@@ -0,0 +1,206 @@
+# coding:utf-8
+"""Module of in-process caches."""
+
+import json
+import sys
+import time
+from collections import OrderedDict
+from hashlib import md5
+
+from tornado.gen import coroutine
+
+from utils import O_O
+
+
+def estimate_size(value):
+    """Estimate memory used by a value, recursing into dicts and lists."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(
+            estimate_size(key) + estimate_size(item)
+            for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+def make_etag(value):
+    """Make a weak ETag from bytes, or the JSON serialization of a value."""
+    if not isinstance(value, bytes):
+        value = json.dumps(value, sort_keys=True).encode()
+    return f'W/"{md5(value).hexdigest()}"'
+
+
+class CacheEntry:
+    """A cached value and its bookkeeping.
+
+    `variants` keeps representations derived from the value, like the
+    serialized or compressed response body, so they are built only once.
+    """
+
+    __slots__ = ('key', 'value', 'size', 'expire_time', 'etag', 'variants',
+                 'owner')
+
+    def __init__(self, key, value, size, expire_time, etag, owner=None):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.expire_time = expire_time
+        self.etag = etag
+        self.variants = dict()
+        self.owner = owner
+
+    def variant(self, name, build):
+        """Get a variant of the value, call `build` to make it if missing."""
+        data = self.variants.get(name)
+        if data is None:
+            data = self.variants[name] = build()
+            self.size += len(data)
+            if self.owner is not None:
+                self.owner.grow(self, len(data))
+        return data
+
+
+class LRUCache:
+    """LRU cache with TTL and a memory cap.
+
+    It is only meant to be used from the IOLoop thread, so no lock is taken.
+    Cached values are shared, callers must not modify them.
+
+    `generation` goes up whenever entries are invalidated, a value loaded
+    across an invalidation is not cached.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.used_bytes = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get_entry(key) is not None
+
+    def get_entry(self, key):
+        """Get the entry of a key, None if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expire_time <= time.time():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        """Get the value of a key."""
+        entry = self.get_entry(key)
+        return default if entry is None else entry.value
+
+    def set(self, key, value, size=None, etag=None):
+        """Cache a value, evict the least recently used ones if full.
+
+        Return the new entry, it is not kept if larger than the cap.
+        """
+        self._remove(key)
+        entry = self._new_entry(key, value, size, etag)
+        if entry.size > self.max_bytes:
+            return entry
+
+        entry.owner = self
+        self._entries[key] = entry
+        self.used_bytes += entry.size
+        self._evict()
+
+        return entry
+
+    def _new_entry(self, key, value, size=None, etag=None):
+        if size is None:
+            size = estimate_size(value)
+        return CacheEntry(key, value, size, time.time() + self.ttl,
+                          etag or make_etag(value))
+
+    def grow(self, entry, size):
+        """Account for data added to a cached entry."""
+        if self._entries.get(entry.key) is entry:
+            self.used_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self.used_bytes > self.max_bytes:
+            _key, evicted = self._entries.popitem(last=False)
+            evicted.owner = None
+            self.used_bytes -= evicted.size
+
+    @coroutine
+    def read_through(self, key, loader):
+        """Get the entry of a key, call `loader` to fill it on a miss.
+
+        :param key: the cache key.
+        :param loader: a coroutine function returning the value, or None if
+            there is nothing to cache.
+        :return: the entry, None if the loader returned None.
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            generation = self.generation
+            value = yield loader()
+            if value is None:
+                return None
+            if generation != self.generation:
+                # Invalidated while loading, the value may be stale.
+                return self._new_entry(key, value)
+            entry = self.set(key, value)
+        return entry
+
+    def discard(self, key):
+        """Remove a key from the cache if present."""
+        self.generation += 1
+        self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.owner = None
+            self.used_bytes -= entry.size
+
+    def discard_by(self, field, value):
+        """Remove every cached dict whose `field` equals `value`."""
+        keys = [
+            key for key, entry in self._entries.items()
+            if isinstance(entry.value, dict)
+            and entry.value.get(field) == value
+        ]
+        self.generation += 1
+        for key in keys:
+            self._remove(key)
+
+    def clear(self):
+        """Remove everything."""
+        self.generation += 1
+        for entry in self._entries.values():
+            entry.owner = None
+        self._entries.clear()
+        self.used_bytes = 0
+
+
+# Article detail merged from MySQL and Mongo, keyed by article_id.
+# Every worker process has its own copy, so changes made through another
+# worker show up here after at most `ttl` seconds.
+ARTICLE_CACHE = LRUCache(
+    max_bytes=O_O.get('cache.article.max_bytes', 64 * 1024 * 1024),
+    ttl=O_O.get('cache.article.ttl', 300))
+
+# Small static files read from disk, keyed by (path, mtime, size).
+FILE_CACHE = LRUCache(
+    max_bytes=O_O.get('cache.file.max_bytes', 16 * 1024 * 1024),
+    ttl=O_O.get('cache.file.ttl', 3600))
+
+# Article and category lists, keyed by the endpoint and its arguments.
+# Any change to articles or categories clears it all.
+LIST_CACHE = LRUCache(
+    max_bytes=O_O.get('cache.list.max_bytes', 16 * 1024 * 1024),
+    ttl=O_O.get('cache.list.ttl', 10))
@@ -0,0 +1,100 @@
+# coding:utf-8
+"""Module of the JSON codec used by handlers.
+
+`dumps` returns bytes and `loads` accepts bytes, so request and response
+bodies are never copied into an intermediate `str`. The backend is picked
+by the `json_backend` option: `orjson`, `ujson`, `json`, or `auto` (the
+default) for the fastest one installed.
+
+Run `python -m utils.codec` to benchmark the installed backends.
+"""
+
+import json
+import time
+
+from utils import O_O
+
+# Every backend raises a subclass of it on invalid input.
+DecodeError = ValueError
+
+
+def _json_dumps(data):
+    return json.dumps(data).encode()
+
+
+def _load_orjson():
+    import orjson
+    return orjson.dumps, orjson.loads
+
+
+def _load_ujson():
+    import ujson
+
+    def dumps(data):
+        """Serialize to bytes."""
+        return ujson.dumps(data, ensure_ascii=False).encode()
+
+    return dumps, ujson.loads
+
+
+def _load_json():
+    return _json_dumps, json.loads
+
+
+BACKENDS = dict(orjson=_load_orjson, ujson=_load_ujson, json=_load_json)
+
+
+def load_backend(name='auto'):
+    """Return (name, dumps, loads) of a backend."""
+    if name != 'auto':
+        return (name, ) + BACKENDS[name]()
+
+    for name in ('orjson', 'ujson', 'json'):
+        try:
+            return (name, ) + BACKENDS[name]()
+        except ImportError:
+            continue
+
+
+BACKEND, dumps, loads = load_backend(O_O.get('json_backend', 'auto'))
+
+
+def bench(size=128 * 1024, rounds=200):
+    """Time the installed backends on an article sized payload."""
+    paragraph = '## 标题\n\nSome *markdown* with `code`, 中文 and "quotes".\n'
+    content = paragraph * (size // len(paragraph.encode()) + 1)
+    data = dict(
+        result=1, status=0, msg='Successfully.',
+        data=dict(article_id='0000-0000-0000-0000', title='Benchmark',
+                  content=content, update_time=int(time.time())))
+    body = json.dumps(data).encode()
+
+    print(f'payload: {len(body) // 1024} KB, {rounds} rounds')
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        json.loads(body.decode('utf-8'))
+    print(f'{"str path":>8}  loads {time.perf_counter() - start:.3f}s', end='')
+    start = time.perf_counter()
+    for _ in range(rounds):
+        json.dumps(data).encode()
+    print(f'  dumps {time.perf_counter() - start:.3f}s')
+
+    for name in BACKENDS:
+        try:
+            _name, _dumps, _loads = load_backend(name)
+        except ImportError:
+            print(f'{name:>8}  not installed')
+            continue
+        start = time.perf_counter()
+        for _ in range(rounds):
+            _loads(body)
+        print(f'{name:>8}  loads {time.perf_counter() - start:.3f}s', end='')
+        start = time.perf_counter()
+        for _ in range(rounds):
+            _dumps(data)
+        print(f'  dumps {time.perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,70 @@
+# coding:utf-8
+"""Module of response compression.
+
+gzip is always available, brotli is used when the `brotli` package is
+installed and the client prefers it.
+"""
+
+import zlib
+
+from utils import O_O
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENABLED = O_O.get('compress.enabled', True)
+MIN_LENGTH = O_O.get('compress.min_length', 1024)
+GZIP_LEVEL = O_O.get('compress.gzip_level', 6)
+BROTLI_QUALITY = O_O.get('compress.brotli_quality', 5)
+
+COMPRESSIBLE_TYPES = frozenset([
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+])
+
+
+def is_compressible(content_type, length):
+    """Check if a response is worth compressing."""
+    if not ENABLED or length < MIN_LENGTH:
+        return False
+    return content_type.split(';')[0].strip() in COMPRESSIBLE_TYPES
+
+
+def accepted_encoding(accept_encoding):
+    """Pick the encoding to use from an `Accept-Encoding` header."""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if not float(params[2:]):
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    """Compress body with the given content encoding."""
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    # wbits 31 writes a gzip header with zero mtime, so the output (and so
+    # its ETag) is the same for the same input.
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
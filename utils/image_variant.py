@@ -0,0 +1,292 @@
+# coding:utf-8
+"""Module of the resized variants of uploaded images.
+
+`/image/<id>.<ext>?w=640` serves a copy of the image at most 640 pixels
+wide. The requested width is rounded up to one of `image_variant.widths`,
+so only a few variants of an image exist. Variants are made by Pillow in a
+process pool, off the IO loop, and written next to the original as
+`<id>.w640.<ext>`, or `<id>.w640.webp` for browsers accepting WebP when
+`image_variant.webp` is on.
+
+Variant files are kept to `image_variant.max_bytes` in total, the ones
+served least recently are deleted first. GIFs, which may be animated, are
+always served as they are, and so is every image when Pillow is missing.
+"""
+
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import time
+import types
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from tornado.ioloop import IOLoop
+
+from utils import O_O
+from utils.metrics import Counter, Gauge
+from utils.prefork import on_fork, on_shutdown
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow not installed
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = sorted(O_O.get('image_variant.widths', [160, 320, 640, 1280]))
+WEBP = O_O.get('image_variant.webp', False)
+QUALITY = O_O.get('image_variant.quality', 82)
+WAIT = O_O.get('image_variant.wait', 5)  # seconds a request waits for one
+
+FORMATS = {'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+VARIANT_PATTERN = re.compile(r'^[a-zA-Z0-9\-]{36}\.w\d+\.(?:jpg|png|webp)$')
+TEMP_PATTERN = re.compile(
+    r'^[a-zA-Z0-9\-]{36}\.w\d+\.(?:jpg|png|webp)\.\d+\.tmp$')
+TOUCH_INTERVAL = 3600  # least seconds between access time updates
+
+VARIANT_REQUESTS = Counter(
+    'image_variant_requests_total', 'Requests of resized images.',
+    labels=('result', ))
+
+
+def pick_width(value, source):
+    """Width of the variant to serve, None to serve the original."""
+    if Image is None or not value or source.endswith('.gif'):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    for width in WIDTHS:
+        if value <= width:
+            return width
+    return None
+
+
+def variant_name(source, width, fmt=None):
+    """File name of a variant of an image, like <id>.w640.jpg."""
+    image_id, ext = os.path.splitext(source)
+    return f'{image_id}.w{width}.{fmt or ext[1:]}'
+
+
+def resize(source_path, target_path, width, fmt, quality):
+    """Write a copy of an image at most `width` pixels wide.
+
+    Runs in the processes of the pool. The copy is written under a
+    temporary name and renamed, so a partial file is never served. An
+    image already narrow enough in the same format is hard linked.
+    Return the number of bytes the variant takes on disk.
+    """
+    temp_path = f'{target_path}.{os.getpid()}.tmp'
+    if os.path.exists(temp_path):  # left by a process which crashed
+        os.remove(temp_path)
+    try:
+        with Image.open(source_path) as image:
+            if image.width <= width and FORMATS[fmt] == image.format:
+                os.link(source_path, temp_path)
+                os.replace(temp_path, target_path)
+                return 0
+
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width, image.height), Image.LANCZOS)
+            if fmt == 'jpg' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            options = dict(optimize=True) if fmt == 'png' else dict(
+                quality=quality)
+            image.save(temp_path, FORMATS[fmt], **options)
+            os.replace(temp_path, target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.getsize(target_path)
+
+
+def scan(root):
+    """List (access time, name, bytes on disk) of the variants in root.
+
+    Runs in the processes of the pool, a large directory takes a while.
+    Temporary files of `resize` older than an hour are removed.
+    """
+    entries = []
+    stale = time.time() - 3600
+    for entry in os.scandir(root):
+        if TEMP_PATTERN.match(entry.name):
+            if entry.stat().st_mtime < stale:
+                os.remove(entry.path)
+        elif VARIANT_PATTERN.match(entry.name):
+            stat_result = entry.stat()
+            entries.append((stat_result.st_atime, entry.name,
+                            disk_size(stat_result)))
+    return sorted(entries)
+
+
+def disk_size(stat_result):
+    """Hard links to an original take no space of their own."""
+    return 0 if stat_result.st_nlink > 1 else stat_result.st_size
+
+
+class VariantStore:
+    """Variant files in a directory, the least recently used deleted first.
+
+    Every worker keeps its own index, loaded from the directory in the pool
+    on first use, in order of access time; until it is loaded variants are
+    served but none deleted. Serving a variant updates its access time,
+    at most once per `TOUCH_INTERVAL`, so the order is shared roughly
+    between workers and kept over restarts. A variant another worker has
+    deleted is found missing and made again.
+    """
+
+    def __init__(self, root, max_bytes, processes=1):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.processes = processes
+        self.files = None
+        self.size = 0
+        self.pending = dict()
+        self.failed = set()
+        self._loading = None
+        self._pool = None
+
+    @property
+    def pool(self):
+        """Process pool making the variants, created on first use.
+
+        Its processes are forked from a fork server which imports only this
+        module, not from the worker, which runs threads and holds sockets
+        and connections. multiprocessing would also import the main module,
+        lazor_main with Mongo and SQL clients, into each of them, so it is
+        hidden while they start; all of them start on the first submit.
+        """
+        if self._pool is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            pool = ProcessPoolExecutor(self.processes, mp_context=context)
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                pool.submit(os.getpid)
+            finally:
+                sys.modules['__main__'] = main
+            self._pool = pool
+        return self._pool
+
+    def close(self):
+        """Stop the process pool, variants being made are dropped."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def reset(self):
+        """Forget the pool and the index, as in a newly forked worker."""
+        self._pool = None
+        self._loading = None
+        self.files = None
+        self.size = 0
+        self.pending.clear()
+
+    def load(self):
+        """Index the variant files in the directory, in the pool."""
+        if self._loading is None:
+            self._loading = self.pool.submit(scan, self.root)
+            IOLoop.current().add_future(self._loading, self._loaded)
+
+    def _loaded(self, future):
+        if future.exception() is not None:
+            logger.warning('indexing image variants failed: %r',
+                           future.exception())
+            self._loading = None
+            return
+        self.files = OrderedDict()
+        self.size = 0
+        for atime, name, size in future.result():
+            self.files[name] = [size, atime]
+            self.size += size
+        self.evict()
+
+    def lookup(self, name):
+        """Return whether a variant exists, and mark it used."""
+        path = os.path.join(self.root, name)
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            if self.files is None:
+                self.load()
+            elif name in self.files:
+                self.size -= self.files.pop(name)[0]
+            return False
+
+        if self.files is None:
+            self.load()
+            return True
+        item = self.files.get(name)
+        if item is None:
+            item = self.files[name] = [disk_size(stat_result), 0]
+            self.size += item[0]
+        self.files.move_to_end(name)
+
+        now = time.time()
+        if now - item[1] > TOUCH_INTERVAL:
+            # Only the access time, the mtime is part of the ETag.
+            os.utime(path, ns=(int(now * 1e9), stat_result.st_mtime_ns))
+            item[1] = now
+        return True
+
+    def make(self, source_path, name, width, fmt):
+        """Make a variant in the pool, return a future of its size.
+
+        Requests of a variant being made share its future. A variant which
+        failed once is not tried again by this worker.
+        """
+        future = self.pending.get(name)
+        if future is None:
+            if name in self.failed:
+                raise ValueError(f'Making image variant {name} failed.')
+            future = self.pool.submit(
+                resize, source_path, os.path.join(self.root, name), width,
+                fmt or os.path.splitext(source_path)[1][1:], QUALITY)
+            self.pending[name] = future
+            IOLoop.current().add_future(future, partial(self._made, name))
+        return future
+
+    def _made(self, name, future):
+        self.pending.pop(name, None)
+        if future.exception() is not None:
+            logger.warning('making image variant %s failed: %r', name,
+                           future.exception())
+            if len(self.failed) > 10000:
+                self.failed.clear()
+            self.failed.add(name)
+            return
+        if self.files is None:
+            self.load()
+            return
+        if name not in self.files:
+            self.files[name] = [future.result(), time.time()]
+            self.size += future.result()
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used variants above max_bytes."""
+        while self.size > self.max_bytes and len(self.files) > 1:
+            name, (size, _) = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+
+VARIANTS = VariantStore(
+    '../static/image',
+    O_O.get('image_variant.max_bytes', 1024 * 1024 * 1024),
+    O_O.get('image_variant.processes', 1))
+
+Gauge('image_variant_bytes', 'Bytes taken by resized images on disk.',
+      function=lambda: VARIANTS.size)
+
+on_fork(VARIANTS.reset)
+on_shutdown(VARIANTS.close)
@@ -0,0 +1,148 @@
+# coding:utf-8
+"""Module of the logging setup.
+
+Records are put on a bounded queue by the calling thread and written as
+JSON lines by a background thread, so a slow log pipe never blocks the
+IOLoop. When the queue is full records are dropped and counted.
+
+Options under `logging`:
+
+    level: level of the root logger.
+    levels: levels per logger name, like `tornado.access: WARNING`.
+    queue_size: max records waiting to be written.
+    max_body: bodies longer than this are cut, see `body_for_log`.
+    body_sample_rate: part of the cut bodies logged at all.
+"""
+
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from utils import O_O
+from utils.metrics import Counter
+from utils.prefork import on_fork, on_shutdown
+
+MAX_BODY = O_O.get('logging.max_body', 512)
+BODY_SAMPLE_RATE = O_O.get('logging.body_sample_rate', 0.1)
+
+# Attributes every LogRecord has, the others come from `extra`.
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord(dict()))) | {
+    'message', 'asctime'}
+
+LOG_DROPPED = Counter(
+    'log_records_dropped', 'Log records dropped with the log queue full.')
+
+_listener = None
+
+
+def body_for_log(body, limit=None):
+    """Make a request or response body fit for a log record.
+
+    Bodies up to `limit` bytes are kept whole. Longer ones are cut to
+    `limit`, and only `logging.body_sample_rate` of them are kept at all,
+    the others are replaced by their length.
+    """
+    if limit is None:
+        limit = MAX_BODY
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode(errors='replace')
+    elif not isinstance(body, str):
+        body = str(body)
+    if len(body) <= limit:
+        return body
+    if random.random() >= BODY_SAMPLE_RATE:
+        return f'<{len(body)} chars>'
+    return f'{body[:limit]}...<{len(body)} chars>'
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as one JSON line, with its `extra` fields."""
+
+    def format(self, record):
+        data = dict(
+            time=time.strftime('%Y-%m-%dT%H:%M:%S',
+                               time.localtime(record.created)) +
+            f'.{int(record.msecs):03d}',
+            level=record.levelname,
+            logger=record.name,
+            msg=record.getMessage())
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler which drops records instead of blocking when full."""
+
+    def prepare(self, record):
+        """Format the message now, keep the traceback apart."""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+def _start_listener(root):
+    """Put a queue handler on the root logger and start its writer."""
+    global _listener
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    log_queue = queue.Queue(O_O.get('logging.queue_size', 10000))
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JSONFormatter())
+    root.addHandler(DroppingQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, stream)
+    _listener.start()
+
+
+def stop():
+    """Write the records left and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def setup():
+    """Configure logging from the `logging` options."""
+    root = logging.getLogger()
+    root.setLevel(O_O.get('logging.level', 'INFO').upper())
+    levels = O_O.get('logging.levels')
+    for name, level in (levels.config.items() if levels else ()):
+        logging.getLogger(name).setLevel(str(level).upper())
+    _start_listener(root)
+
+
+@on_fork
+def _restart():
+    """The writer thread is not inherited by a fork, start a new one."""
+    global _listener
+    if _listener is not None:
+        _listener = None
+        _start_listener(logging.getLogger())
+
+
+on_shutdown(stop)
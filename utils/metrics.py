@@ -0,0 +1,161 @@
+# coding:utf-8
+"""Module of process metrics in the Prometheus text format.
+
+Metrics are registered when created and all of them are rendered by
+`expose`. They may be updated from executor threads, so every update
+takes the metric's lock.
+
+Every worker process keeps its own values, with `server.processes` above
+1 a scrape sees the worker that happened to accept it.
+"""
+
+import math
+import threading
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"')
+         .replace('\n', r'\n'))
+        for name, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base of metrics, values are kept per tuple of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = dict()
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                f'{self.name} takes labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value)."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield '', key, (), value
+
+    def expose(self):
+        """Render the metric as lines of text."""
+        lines = [f'# HELP {self.name} {self.doc}',
+                 f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            labels = _format_labels(self.labels, key, extra)
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add amount."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    With `function`, the value is read from it at every scrape instead.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), function=None):
+        super(Gauge, self).__init__(name, doc, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        """Set the value."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """Add amount."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Subtract amount."""
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            yield '', (), (), self.function()
+            return
+        yield from super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf, )
+
+    def observe(self, value, **labels):
+        """Record a value."""
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts))
+                     for key, counts in self._values.items()]
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield '_bucket', key, (('le', _format_value(bound)), ), total
+            yield '_sum', key, (), counts[-1]
+            yield '_count', key, (), total
+
+
+def expose():
+    """Render every registered metric."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
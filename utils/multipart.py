@@ -0,0 +1,248 @@
+# coding:utf-8
+"""Module of an incremental multipart/form-data parser.
+
+`MultipartParser` is fed the body chunk by chunk, as a handler decorated
+with `stream_request_body` receives it, and hands the content of each
+part to a sink as it arrives. `FormReceiver` is the usual sink: files are
+hashed while being written to a `SpooledTemporaryFile`, which stays in
+memory up to `spool_size` bytes and moves to disk above it.
+"""
+
+import re
+from hashlib import md5, sha1
+from tempfile import SpooledTemporaryFile
+
+from tornado.httputil import HTTPHeaders
+
+PARAM_PATTERN = re.compile(r';\s*([\w\-*]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+class MultipartError(ValueError):
+    """Raised when a body is not valid multipart/form-data."""
+
+
+def parse_boundary(content_type):
+    """Return the boundary of a multipart/form-data Content-Type."""
+    if not content_type or \
+            not content_type.lower().startswith('multipart/form-data'):
+        raise MultipartError('Content-Type is not multipart/form-data.')
+    params = parse_params(content_type)
+    if not params.get('boundary'):
+        raise MultipartError('Boundary of multipart body missing.')
+    return params['boundary'].encode('latin1')
+
+
+def parse_params(value):
+    """Parse the parameters of a header like Content-Disposition."""
+    params = dict()
+    for name, param in PARAM_PATTERN.findall(value):
+        if param.startswith('"'):
+            param = re.sub(r'\\(.)', r'\1', param[1:-1])
+        params[name.lower()] = param.strip()
+    return params
+
+
+class MultipartParser:
+    """Split a multipart body fed in chunks into parts.
+
+    For every part `part_factory(headers)` is called with its
+    `HTTPHeaders`, and returns a sink with `write(data)` and `finish()`.
+    """
+
+    def __init__(self, boundary, part_factory, max_header_size=16384):
+        self.part_factory = part_factory
+        self.max_header_size = max_header_size
+        self._first = b'--' + boundary
+        self._delimiter = b'\r\n--' + boundary
+        self._buffer = b''
+        self._state = self._preamble
+        self._part = None
+        self.done = False
+
+    def feed(self, data):
+        """Parse a chunk of the body."""
+        self._buffer += data
+        while self._buffer and self._state():
+            pass
+
+    def close(self):
+        """Check the whole body was received."""
+        if not self.done:
+            raise MultipartError('Multipart body incomplete.')
+
+    def _preamble(self):
+        index = self._buffer.find(self._first)
+        if index < 0:
+            self._buffer = self._buffer[-len(self._first):]
+            return False
+        self._buffer = self._buffer[index + len(self._first):]
+        self._state = self._after_delimiter
+        return True
+
+    def _after_delimiter(self):
+        if len(self._buffer) < 2:
+            return False
+        if self._buffer.startswith(b'--'):
+            self.done = True
+            self._buffer = b''
+            self._state = self._epilogue
+            return False
+        if not self._buffer.startswith(b'\r\n'):
+            raise MultipartError('Invalid multipart delimiter.')
+        self._buffer = self._buffer[2:]
+        self._state = self._headers
+        return True
+
+    def _headers(self):
+        index = self._buffer.find(b'\r\n\r\n')
+        if index < 0:
+            if len(self._buffer) > self.max_header_size:
+                raise MultipartError('Headers of multipart part too large.')
+            return False
+        try:
+            headers = HTTPHeaders.parse(
+                self._buffer[:index].decode('utf-8', errors='replace'))
+        except ValueError:
+            raise MultipartError('Invalid headers of multipart part.')
+        self._buffer = self._buffer[index + 4:]
+        self._part = self.part_factory(headers)
+        self._state = self._body
+        return True
+
+    def _body(self):
+        index = self._buffer.find(self._delimiter)
+        if index < 0:
+            # Keep a tail which may be the start of the delimiter.
+            keep = len(self._delimiter) - 1
+            if len(self._buffer) > keep:
+                self._part.write(self._buffer[:-keep])
+                self._buffer = self._buffer[-keep:]
+            return False
+        self._part.write(self._buffer[:index])
+        self._part.finish()
+        self._part = None
+        self._buffer = self._buffer[index + len(self._delimiter):]
+        self._state = self._after_delimiter
+        return True
+
+    def _epilogue(self):
+        self._buffer = b''
+        return False
+
+
+class UploadedFile:
+    """A file part, spooled and hashed while it is received."""
+
+    def __init__(self, name, filename, content_type, spool_size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = SpooledTemporaryFile(spool_size)
+        self.md5 = md5()
+        self.sha1 = sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.md5.update(data)
+        self.sha1.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+
+class FieldPart:
+    """A form field part, kept in memory up to `max_size` bytes."""
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise MultipartError(f'Field {self.name} too large.')
+        self.chunks.append(data)
+
+    def finish(self):
+        pass
+
+    @property
+    def value(self):
+        return b''.join(self.chunks).decode('utf-8', errors='replace')
+
+
+class FormReceiver:
+    """Part factory collecting the files and fields of a form.
+
+    `files` and `arguments` map names to lists, like the ones of
+    `HTTPServerRequest`. At most `max_size` bytes of file content are
+    taken in total.
+    """
+
+    def __init__(self, spool_size=1024 * 1024, max_size=None,
+                 max_field_size=65536):
+        self.spool_size = spool_size
+        self.max_size = max_size
+        self.max_field_size = max_field_size
+        self.files = dict()
+        self.fields = dict()
+        self.size = 0
+
+    def __call__(self, headers):
+        disposition = headers.get('Content-Disposition', '')
+        if not disposition.lower().startswith('form-data'):
+            raise MultipartError('Part is not form-data.')
+        params = parse_params(disposition)
+        name = params.get('name')
+        if name is None:
+            raise MultipartError('Part without a name.')
+        if 'filename' not in params:
+            part = FieldPart(name, self.max_field_size)
+            self.fields.setdefault(name, []).append(part)
+            return part
+        part = UploadedFile(
+            name, params['filename'],
+            headers.get('Content-Type', 'application/octet-stream'),
+            self.spool_size)
+        self.files.setdefault(name, []).append(part)
+        if self.max_size is not None:
+            return _Limited(self, part)
+        return part
+
+    @property
+    def arguments(self):
+        """Values of the form fields by name."""
+        return {
+            name: [part.value for part in parts]
+            for name, parts in self.fields.items()
+        }
+
+    def close(self):
+        """Close every spooled file."""
+        for parts in self.files.values():
+            for part in parts:
+                part.close()
+
+
+class _Limited:
+    """Count the bytes written to a file part against the form's limit."""
+
+    def __init__(self, receiver, part):
+        self.receiver = receiver
+        self.part = part
+
+    def write(self, data):
+        self.receiver.size += len(data)
+        if self.receiver.size > self.receiver.max_size:
+            raise MultipartError('Uploaded files too large.')
+        self.part.write(data)
+
+    def finish(self):
+        self.part.finish()
@@ -0,0 +1,151 @@
+# coding:utf-8
+"""Module of the pre-fork server mode."""
+
+import logging
+import os
+import signal
+import sys
+
+from tornado import ioloop
+from tornado.process import cpu_count
+
+logger = logging.getLogger(__name__)
+
+_FORK_HOOKS = []
+_SHUTDOWN_HOOKS = []
+
+
+def on_fork(callback):
+    """Register a callback to run in every forked worker."""
+    _FORK_HOOKS.append(callback)
+    return callback
+
+
+def on_shutdown(callback):
+    """Register a callback to run before a worker exits."""
+    _SHUTDOWN_HOOKS.append(callback)
+    return callback
+
+
+def run_shutdown_hooks():
+    """Run the shutdown callbacks, in reverse order of registration."""
+    for callback in reversed(_SHUTDOWN_HOOKS):
+        try:
+            callback()
+        except Exception:
+            logger.exception('shutdown hook %r failed', callback)
+
+
+def _spawn(task_id, children):
+    """Fork one worker, return its task id in the child, None in parent."""
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for callback in _FORK_HOOKS:
+            callback()
+        return task_id
+    children[pid] = task_id
+    return None
+
+
+def fork_workers(num_processes=0, max_restarts=100):
+    """Fork worker processes and supervise them.
+
+    Listening sockets should be bound before calling this, so every worker
+    accepts on the same ones. A worker killed by a signal or exiting with a
+    non-zero status is restarted, at most `max_restarts` times in total.
+    SIGTERM/SIGINT on the supervisor is passed on to the workers, and the
+    supervisor exits after all of them have gone.
+
+    Return the task id (0 to num_processes - 1) in the worker processes,
+    the supervisor process never returns.
+    """
+    if not num_processes:
+        num_processes = cpu_count()
+
+    children = dict()
+    for i in range(num_processes):
+        task_id = _spawn(i, children)
+        if task_id is not None:
+            return task_id
+
+    stopping = []
+
+    def stop(signum, _frame):
+        """Pass the signal on to all workers."""
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        task_id = children.pop(pid, None)
+        if task_id is None:
+            continue
+
+        if os.WIFSIGNALED(status):
+            logger.warning('worker %d (pid %d) killed by signal %d',
+                           task_id, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) != 0:
+            logger.warning('worker %d (pid %d) exited with status %d',
+                           task_id, pid, os.WEXITSTATUS(status))
+        else:
+            logger.info('worker %d (pid %d) exited', task_id, pid)
+            continue
+
+        if stopping:
+            continue
+
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError('Too many worker restarts, giving up.')
+        task_id = _spawn(task_id, children)
+        if task_id is not None:
+            return task_id
+
+    sys.exit(0)
+
+
+def install_graceful_shutdown(server, pending, wait=10):
+    """Drain in-flight requests on SIGTERM/SIGINT, then stop the IOLoop.
+
+    :param server: the `HTTPServer` to stop accepting connections.
+    :param pending: callable returning the number of in-flight requests.
+    :param wait: max seconds to wait for in-flight requests.
+    """
+    io_loop = ioloop.IOLoop.current()
+
+    def drain():
+        """Stop listening and poll until the worker is idle."""
+        server.stop()
+        deadline = io_loop.time() + wait
+
+        def check():
+            """Stop the IOLoop once idle or out of time."""
+            if pending() and io_loop.time() < deadline:
+                io_loop.call_later(0.1, check)
+                return
+            run_shutdown_hooks()
+            io_loop.stop()
+
+        check()
+
+    def stop(_signum, _frame):
+        """Signal handler."""
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        io_loop.add_callback_from_signal(drain)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
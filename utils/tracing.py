@@ -0,0 +1,101 @@
+# coding:utf-8
+"""Module of per-request tracing.
+
+Each request handled by `BaseHandler` gets a `Trace`, identified by the
+`X-Request-Id` header of the request or a new id, which is sent back in the
+response. Spans are recorded for database tasks, Mongo calls, COS calls
+and fetches. Traces slower than `tracing.slow_ms` are kept in
+`SLOW_TRACES`, a ring buffer of the last `tracing.ring_size` ones.
+"""
+
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
+from uuid import uuid4
+
+from utils import O_O
+
+SLOW_MS = O_O.get('tracing.slow_ms', 500)
+
+SLOW_TRACES = deque(maxlen=O_O.get('tracing.ring_size', 100))
+
+# Accept ids from a proxy only if they look like one.
+REQUEST_ID_PATTERN = re.compile(r'^[0-9A-Za-z\-_.]{8,64}$')
+
+
+def new_request_id(header=None):
+    """Use the id from a request header if valid, or make a new one."""
+    if header and REQUEST_ID_PATTERN.match(header):
+        return header
+    return uuid4().hex
+
+
+class Trace:
+    """Spans recorded during one request.
+
+    Spans may be recorded from executor threads, appending to a list is
+    atomic so no lock is taken.
+    """
+
+    def __init__(self, request_id, name):
+        self.request_id = request_id
+        self.name = name
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.spans = []
+
+    def record(self, name, start, end, error=None):
+        """Record a span from two `time.perf_counter` readings."""
+        span = dict(
+            name=name,
+            start_ms=round((start - self.start) * 1000, 3),
+            duration_ms=round((end - start) * 1000, 3))
+        if error is not None:
+            span['error'] = error
+        self.spans.append(span)
+
+    @contextmanager
+    def span(self, name):
+        """Record the time spent in a with block."""
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as exception:
+            error = repr(exception)
+            raise
+        finally:
+            self.record(name, start, time.perf_counter(), error)
+
+    def track(self, name, future):
+        """Record a span ending when a future resolves, return the future."""
+        start = time.perf_counter()
+
+        def done(future):
+            """Record the span."""
+            exception = future.exception()
+            self.record(name, start, time.perf_counter(),
+                        None if exception is None else repr(exception))
+
+        future.add_done_callback(done)
+        return future
+
+    def finish(self, status):
+        """End the trace, keep it if it was slow."""
+        self.duration = (time.perf_counter() - self.start) * 1000
+        self.status = status
+        if self.duration >= SLOW_MS:
+            SLOW_TRACES.append(self.to_dict())
+
+    def to_dict(self):
+        """Return the trace as a dict."""
+        return dict(
+            request_id=self.request_id,
+            name=self.name,
+            start_time=self.start_time,
+            duration_ms=self.duration and round(self.duration, 3),
+            status=self.status,
+            spans=list(self.spans))
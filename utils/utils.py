@@ -19,15 +19,31 @@ def generate_id(namespace='0000'):
     return f'{namespace}-{timep[4:8]}-{timep[:4]}-{rands}-{timep[8:]}'
 
 
+class BoundTask:
+    """A task with some keyword arguments bound."""
+
+    def __init__(self, task, bound):
+        self.task = task
+        self.bound = bound
+
+    def __call__(self, *args, **kwargs):
+        return self.task(*args, **dict(self.bound, **kwargs))
+
+    def delay(self, *args, **kwargs):
+        """Run the task without blocking, return a future of its result."""
+        return self.task.delay(*args, **dict(self.bound, **kwargs))
+
+
 class Tasks:
     """Manager Class of Tasks."""
 
-    def __init__(self, params):
+    def __init__(self, params, bound=None):
         if isinstance(params, dict):
             self.tasks = params
         else:
             raise TypeError(
                 f'Arguments data should be a "dict" not {type(params)}.')
+        self.bound = bound or dict()
 
     def __getattr__(self, task_name):
         return self._get_task(task_name)
@@ -47,9 +63,19 @@ class Tasks:
         """Return the keys of the task dictionary."""
         return self.tasks.keys
 
+    def bind(self, **bound):
+        """Return the tasks with keyword arguments bound, like `uow`."""
+        return Tasks(self.tasks, dict(self.bound, **bound))
+
+    def delay(self, task_name, *args, **kwargs):
+        """Run a task without blocking, return a future of its result."""
+        return self._get_task(task_name).delay(*args, **kwargs)
+
     def _get_task(self, name):
         task = self.tasks.get(name)
         if task is None:
             raise KeyError(name)
+        elif self.bound:
+            return BoundTask(task, self.bound)
         else:
             return task
@@ -1,11 +1,45 @@
 # coding:utf-8
 """Views' Module of Article."""
 from tornado.gen import coroutine
-from tornado.web import asynchronous
+from tornado.web import HTTPError, asynchronous
 
 from base_handler import BaseHandler, ENFORCED, OPTIONAL
+from config import CFG as config
+from utils.cache import ARTICLE_CACHE, LIST_CACHE
 from utils.utils import generate_id
-from workers.task_database import TASKS as tasks
+
+MAX_PAGE_SIZE = config.get('article.max_page_size', 100)
+
+
+def parse_page(page_size, before):
+    """Parse paging arguments to (page_size, before).
+
+    `before` is the `next` cursor of the previous page, formatted as
+    `create_time,article_id`. Raise ValueError if either is malformed.
+    """
+    if page_size:
+        page_size = min(int(page_size), MAX_PAGE_SIZE)
+        if page_size < 1:
+            raise ValueError(page_size)
+    else:
+        page_size = None
+
+    if before:
+        before_time, _, before_id = before.partition(',')
+        before = (int(before_time), before_id)
+    else:
+        before = None
+
+    return page_size, before
+
+
+def paginate(article_list, page_size):
+    """Trim a list queried with `page_size + 1`, return (page, next)."""
+    if not page_size or len(article_list) <= page_size:
+        return article_list, None
+    article_list = article_list[:page_size]
+    last = article_list[-1]
+    return article_list, f'{last["create_time"]},{last["article_id"]}'
 
 
 class Article(BaseHandler):
@@ -16,15 +50,23 @@ class Article(BaseHandler):
     def get(self, *_args, **_kwargs):
         args = self.parse_form_arguments(article_id=ENFORCED)
 
-        query_result = tasks.query_article(article_id=args.article_id)
-        if not query_result:
-            return self.fail(4004)
+        @coroutine
+        def load():
+            query_result = yield self.tasks.query_article.delay(
+                article_id=args.article_id)
+            if not query_result or 'article_id' not in query_result:
+                return None
 
-        article_content = self.article_content.find_one(
-            dict(article_id=args.article_id))
+            article_content = yield self.article_content.find_one(
+                dict(article_id=args.article_id))
+
+            return dict(query_result, content=article_content['content'])
+
+        entry = yield ARTICLE_CACHE.read_through(args.article_id, load)
+        if not entry:
+            return self.fail(4004)
 
-        self.success(
-            data=dict(query_result, content=article_content['content']))
+        self.success_with_etag(entry)
 
     @asynchronous
     @coroutine
@@ -39,18 +81,20 @@ class Article(BaseHandler):
             content=OPTIONAL,
             category_id=OPTIONAL)
 
+        uow_tasks = self.tasks.bind(uow=self.uow)
+
         if args.title or args.category_id:
             check_list = ('title', 'category_id')
             update_dict = dict((arg, args.get(arg)) for arg in args.arguments
                                if arg in check_list)
 
-            update_result = tasks.update_article(
+            update_result = yield uow_tasks.update_article.delay(
                 article_id=args.article_id, **update_dict)
             if not update_result['result']:
                 return self.fail(5003)
 
         if args.content:
-            update_result = self.article_content.update_one(
+            update_result = yield self.article_content.update_one(
                 {
                     'article_id': args.article_id
                 }, {'$set': {
@@ -60,7 +104,14 @@ class Article(BaseHandler):
             if not update_result:
                 return self.fail(5003)
 
-        query_result = tasks.query_article(article_id=args.article_id)
+        query_result = yield uow_tasks.query_article.delay(
+            article_id=args.article_id)
+
+        committed = yield self.uow.commit()
+        if not committed:
+            return self.fail(5003)
+        ARTICLE_CACHE.discard(args.article_id)
+        LIST_CACHE.clear()
 
         self.success(data=dict(query_result, content=args.content))
 
@@ -74,18 +125,19 @@ class Article(BaseHandler):
         args = self.parse_json_arguments(
             category_id=ENFORCED)
 
-        insert_result = tasks.insert_article(
+        insert_result = yield self.tasks.insert_article.delay(
             user_id=_params.user_id,
             title='无标题文章',
             content='',
             category_id=args.category_id)
 
-        update_result = self.article_content.update_one(
+        update_result = yield self.article_content.update_one(
             dict(article_id=insert_result['data']['article_id']),
             {'$set': {
                 'content': ''
             }},
             upsert=True)
+        LIST_CACHE.clear()
 
         self.success(data=dict(insert_result['data']))
 
@@ -98,14 +150,22 @@ class Article(BaseHandler):
 
         args = self.parse_form_arguments(article_id=ENFORCED)
 
-        query_result = tasks.query_article(article_id=args.article_id)
+        uow_tasks = self.tasks.bind(uow=self.uow)
+
+        query_result = yield uow_tasks.query_article.delay(
+            article_id=args.article_id)
         if not query_result:
             return self.fail(4004)
         if query_result['user_id'] != _params.user_id:
             return self.fail(4005)
 
-        tasks.delete_article(article_id=args.article_id)
-        self.article_content.delete_one({'article_id': args.article_id})
+        yield uow_tasks.delete_article.delay(article_id=args.article_id)
+        committed = yield self.uow.commit()
+        if not committed:
+            return self.fail(5003)
+        yield self.article_content.delete_one({'article_id': args.article_id})
+        ARTICLE_CACHE.discard(args.article_id)
+        LIST_CACHE.clear()
 
         self.success()
 
@@ -132,10 +192,12 @@ class ArticlePublishState(BaseHandler):
         args = self.parse_json_arguments(
             article_id=ENFORCED, publish_status=ENFORCED)
 
-        _update_result = tasks.update_article_publish_state(
+        _update_result = yield self.tasks.update_article_publish_state.delay(
             article_id=args.article_id,
             publish_status=args.publish_status,
         )
+        ARTICLE_CACHE.discard(args.article_id)
+        LIST_CACHE.clear()
 
         self.success()
 
@@ -147,21 +209,43 @@ class UserArticleList(BaseHandler):
     @coroutine
     def get(self, *_args, **_kwargs):
 
-        args = self.parse_form_arguments(category_id=ENFORCED, )
+        args = self.parse_form_arguments(
+            category_id=ENFORCED, page_size=OPTIONAL, before=OPTIONAL)
 
-        query_result = tasks.query_article_info_list(
-            category_id=args.category_id)
+        try:
+            page_size, before = parse_page(args.page_size, args.before)
+        except ValueError:
+            raise HTTPError(400, 'Invalid page_size or before.')
+
+        @coroutine
+        def load():
+            query_result = yield self.tasks.query_article_info_list.delay(
+                category_id=args.category_id,
+                before=before,
+                limit=page_size and page_size + 1)
+            if not isinstance(query_result, list):
+                return None
+            query_result, next_page = paginate(query_result, page_size)
+
+            order_list = yield self.article_order.find_one({
+                'category_id':
+                args.category_id
+            })
 
-        order_list = self.article_order.find_one({
-            'category_id':
-            args.category_id
-        })
+            if order_list:
+                order_list = order_list.get('article_order')
 
-        if order_list:
-            order_list = order_list.get('article_order')
+            return dict(
+                article_list=query_result,
+                order_list=order_list,
+                next=next_page)
 
-        self.success(
-            data=dict(article_list=query_result, order_list=order_list))
+        entry = yield LIST_CACHE.read_through(
+            ('user-list', args.category_id, page_size, before), load)
+        if not entry:
+            return self.fail(5003)
+
+        self.success_with_etag(entry)
 
 
 class IndexArticleList(BaseHandler):
@@ -171,16 +255,38 @@ class IndexArticleList(BaseHandler):
     @coroutine
     def get(self, *_args, **_kwargs):
 
-        args = self.parse_form_arguments(limit=ENFORCED)
+        args = self.parse_form_arguments(limit=ENFORCED, before=OPTIONAL)
+
+        try:
+            page_size, before = parse_page(
+                args.limit or MAX_PAGE_SIZE, args.before)
+        except ValueError:
+            raise HTTPError(400, 'Invalid limit or before.')
+
+        @coroutine
+        def load():
+            query_result = yield self.tasks.query_article_info_list.delay(
+                before=before, limit=page_size + 1)
+            if not isinstance(query_result, list):
+                return None
+            query_result, next_page = paginate(query_result, page_size)
 
-        query_result = tasks.query_article_info_list(limit=args.limit)
+            return dict(
+                article_list=query_result, order_list=None, next=next_page)
 
-        self.success(data=dict(article_list=query_result, order_list=None))
+        entry = yield LIST_CACHE.read_through(
+            ('index-list', page_size, before), load)
+        if not entry:
+            return self.fail(5003)
+
+        self.success_with_etag(entry)
 
 
 class ArticleOrder(BaseHandler):
     """Handler category order stuff."""
 
+    @asynchronous
+    @coroutine
     def post(self, *_args, **_kwargs):
         _params = self.check_auth(2)
         if not _params:
@@ -189,13 +295,14 @@ class ArticleOrder(BaseHandler):
         args = self.parse_json_arguments(
             category_id=ENFORCED, order_list=ENFORCED)
 
-        self.article_order.update(
+        yield self.article_order.update(
             {
                 'category_id': args.category_id
             }, {'$set': {
                 'article_order': args.order_list
             }},
             upsert=True)
+        LIST_CACHE.clear()
 
         self.success()
 
@@ -7,7 +7,7 @@ from tornado.web import asynchronous
 
 from base_handler import BaseHandler, ENFORCED, OPTIONAL
 from config import CFG as config
-from workers.task_database import TASKS as tasks
+from utils.cache import ARTICLE_CACHE, LIST_CACHE
 
 
 class Category(BaseHandler):
@@ -20,10 +20,10 @@ class Category(BaseHandler):
         if not _params:
             return
 
-        query_result = tasks.query_category_by_user_id(
+        query_result = yield self.tasks.query_category_by_user_id.delay(
             user_id=_params.user_id)
 
-        order_list = self.category_order.find_one(
+        order_list = yield self.category_order.find_one(
             {'user_id': _params.user_id})
 
         if order_list:
@@ -44,9 +44,11 @@ class Category(BaseHandler):
             category_id=ENFORCED,
             category_name=ENFORCED)
 
-        update_result = tasks.update_category_name(
+        update_result = yield self.tasks.update_category_name.delay(
             category_id=args.category_id,
             category_name=args.category_name)
+        ARTICLE_CACHE.discard_by('category_id', args.category_id)
+        LIST_CACHE.clear()
 
         self.success()
 
@@ -60,10 +62,11 @@ class Category(BaseHandler):
         args = self.parse_json_arguments(
             category_name=ENFORCED)
 
-        insert_result = tasks.insert_category(
+        insert_result = yield self.tasks.insert_category.delay(
             category_name=args.category_name,
             category_type=1,
             user_id=_params.user_id)
+        LIST_CACHE.clear()
 
         self.success()
 
@@ -77,11 +80,18 @@ class Category(BaseHandler):
         args = self.parse_form_arguments(
             category_id=ENFORCED)
 
-        delete_result = tasks.delete_category(
+        uow_tasks = self.tasks.bind(uow=self.uow)
+
+        delete_result = yield uow_tasks.delete_category.delay(
             category_id=args.category_id)
 
-        _update_result = tasks.delete_article_by_category_id(
+        _update_result = yield uow_tasks.delete_article_by_category_id.delay(
             category_id=args.category_id)
+        committed = yield self.uow.commit()
+        if not committed:
+            return self.fail(5003)
+        ARTICLE_CACHE.discard_by('category_id', args.category_id)
+        LIST_CACHE.clear()
 
         self.success(data=delete_result)
 
@@ -93,14 +103,27 @@ class CategoryIndexList(BaseHandler):
     @coroutine
     def get(self, *_args, **_kwargs):
 
-        query_result = tasks.query_category_by_category_order()
+        @coroutine
+        def load():
+            query_result = (
+                yield self.tasks.query_category_by_category_order.delay())
+            if not isinstance(query_result, list):
+                return None
+
+            return dict(category_list=query_result)
+
+        entry = yield LIST_CACHE.read_through(('category-index', ), load)
+        if not entry:
+            return self.fail(5003)
 
-        self.success(data=dict(category_list=query_result))
+        self.success_with_etag(entry)
 
 
 class CategoryOrder(BaseHandler):
     """Handler category order stuff."""
 
+    @asynchronous
+    @coroutine
     def post(self, *_args, **_kwargs):
         _params = self.check_auth(2)
         if not _params:
@@ -109,9 +132,10 @@ class CategoryOrder(BaseHandler):
         args = self.parse_json_arguments(
             order_list=ENFORCED)
 
-        self.category_order.update({'user_id': _params.user_id},
-                                   {'$set': {'category_order': args.order_list}},
-                                   upsert=True)
+        yield self.category_order.update(
+            {'user_id': _params.user_id},
+            {'$set': {'category_order': args.order_list}},
+            upsert=True)
 
         self.success()
 
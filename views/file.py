@@ -1,28 +1,187 @@
 # coding:utf-8
 """Views' Module of Article."""
+import hmac
+import json
 import re
 import os
+import secrets
+from hashlib import sha1
 from uuid import uuid1 as uuid
 import time
-from hashlib import md5, sha1
+from pymongo.errors import DuplicateKeyError
 from tornado.gen import coroutine
-from tornado.web import asynchronous
+from tornado.httputil import parse_body_arguments
+from tornado.web import (HTTPError, MissingArgumentError, asynchronous,
+                         decode_signed_value,
+                         stream_request_body)
 
 from base_handler import BaseHandler, ENFORCED, OPTIONAL
+from models.image_digest import IMAGE_DIGESTS
+from utils.multipart import (FormReceiver, MultipartError, MultipartParser,
+                             parse_boundary)
 from utils.utils import generate_id
 from config import CFG as config
+from workers.image_gc import image_key
 from workers.task_database import TASKS as tasks
-from lib.qcos.bucket import Bucket
+from lib.qcos.async_client import AsyncBucket
+from lib.qcos.exception import CosClientError, CosServiceError
 
-qcos_bucket = Bucket(
+qcos_bucket = AsyncBucket(
     bucket=config.cos.bucket,
     access_id=config.cos.access_id,
     access_key=config.cos.access_key,
     region=config.cos.region,
-    appid=config.cos.appid)
+    appid=config.cos.appid,
+    max_clients=config.get('cos.max_clients', 10),
+    backend=config.get('cos.backend', 'simple'),
+    endpoint=config.get('cos.endpoint'),
+    retry=config.get('cos.retry', 1))
+
+MAX_UPLOAD_SIZE = config.get('upload.max_size', 100 * 1024 * 1024)
+SPOOL_SIZE = config.get('upload.spool_size', 1024 * 1024)
+
+
+@coroutine
+def find_image(collection, md5_code, sha1_code):
+    """The image record with this content, None if there is none."""
+    if not IMAGE_DIGESTS.might_exist(md5_code, sha1_code):
+        return None
+    exist = yield collection.find_one({
+        'md5_code': md5_code,
+        'sha1_code': sha1_code
+    })
+    return exist
+
+
+@coroutine
+def claim_image(collection, exist, user_id=None, name=None):
+    """Mark an image found by its content as uploaded again.
+
+    The update time is always bumped, so image_gc does not collect the
+    image before the article linking to it is saved. A record without
+    a user is given to `user_id`, if one is given.
+    """
+    update = dict(update_time=int(time.time()))
+    if user_id is not None and 'user_id' not in exist:
+        update.update(user_id=user_id, name=name)
+    yield collection.update_one({
+        'md5_code': exist['md5_code'],
+        'sha1_code': exist['sha1_code']
+    }, {'$set': update})
+
+
+@stream_request_body
+class UploadHandler(BaseHandler):
+    """Base of handlers taking multipart uploads by PUT.
+
+    The body of a PUT is parsed while it arrives: files are hashed and
+    spooled to disk above `upload.spool_size`, and never held whole in
+    memory. Bodies of other methods are buffered, call `load_body` before
+    reading them; `parse_form_arguments` and `parse_json_arguments` do.
+    """
+
+    def prepare(self):
+        self._chunks = []
+        self._form = None
+        self._parser = None
+        self._upload_error = None
+        self.upload_params = None
+        if self.request.method != 'PUT':
+            return
+
+        self.upload_params = self.check_auth(2)
+        if not self.upload_params:
+            return
+        self.request.connection.set_max_body_size(MAX_UPLOAD_SIZE)
+        self._form = FormReceiver(
+            spool_size=SPOOL_SIZE, max_size=MAX_UPLOAD_SIZE)
+        try:
+            self._parser = MultipartParser(
+                parse_boundary(self.request.headers.get('Content-Type')),
+                self._form)
+        except MultipartError as exception:
+            self._upload_error = str(exception)
+
+    def data_received(self, chunk):
+        if self.request.method != 'PUT':
+            self._chunks.append(chunk)
+        elif self._parser is not None and self._upload_error is None:
+            try:
+                self._parser.feed(chunk)
+            except MultipartError as exception:
+                self._upload_error = str(exception)
+                self._form.close()
+
+    def on_finish(self):
+        if self._form is not None:
+            self._form.close()
+        super(UploadHandler, self).on_finish()
+
+    def load_body(self):
+        """Set the buffered body as `request.body` and parse arguments."""
+        if self._chunks is None:
+            return
+        self.request.body = b''.join(self._chunks)
+        self._chunks = None
+        parse_body_arguments(
+            self.request.headers.get('Content-Type', ''), self.request.body,
+            self.request.body_arguments, self.request.files,
+            self.request.headers)
+        for name, values in self.request.body_arguments.items():
+            self.request.arguments.setdefault(name, []).extend(values)
+
+    def parse_form_arguments(self, **keys):
+        self.load_body()
+        return super(UploadHandler, self).parse_form_arguments(**keys)
+
+    def parse_json_arguments(self, **keys):
+        self.load_body()
+        return super(UploadHandler, self).parse_json_arguments(**keys)
+
+    def uploaded_files(self, name='file'):
+        """Files uploaded in field `name`, None if the request failed."""
+        if self._upload_error is None:
+            try:
+                self._parser.close()
+            except MultipartError as exception:
+                self._upload_error = str(exception)
+        if self._upload_error is not None:
+            self.set_status(400)
+            self.fail(4001, data=self._upload_error)
+            return None
+        if name not in self._form.files:
+            raise MissingArgumentError(name)
+        return self._form.files[name]
+
+    @coroutine
+    def store_image(self, body, record):
+        """Upload an image and insert its record, return the record kept.
+
+        If a concurrent upload stored the same content first, the unique
+        index rejects the insert; the object just uploaded is deleted and
+        the record of the other upload returned.
+        """
+        key = image_key(record['path'])
+        yield self.trace.track(
+            'cos put_object', qcos_bucket.put_object(path=key, body=body))
+        try:
+            yield self.image.insert(record)
+        except DuplicateKeyError as exception:
+            exist = yield self.image.find_one({
+                'md5_code': record['md5_code'],
+                'sha1_code': record['sha1_code']
+            })
+            if not exist:
+                raise exception
+            yield self.trace.track(
+                'cos delete_object', qcos_bucket.delete_object(path=key))
+            yield claim_image(self.image, exist)
+            return exist
+        IMAGE_DIGESTS.add(record['md5_code'], record['sha1_code'])
+        return record
 
 
-class File(BaseHandler):
+class File(UploadHandler):
     """Handler file stuff."""
 
     # @asynchronous
@@ -59,25 +218,23 @@ class File(BaseHandler):
     @asynchronous
     @coroutine
     def put(self, *_args, **_kwargs):
-        _params = self.check_auth(2)
-        if not _params:
+        _params = self.upload_params
+        uploads = self.uploaded_files()
+        if uploads is None:
             return
 
-        file_meta = self.request.files
         file_list = []
-        for fp in file_meta['file']:
-            filename, ext = os.path.splitext(fp['filename'])
+        for fp in uploads:
+            filename, ext = os.path.splitext(fp.filename)
 
             ext = ext.lower()
             image_id = str(uuid())
-            md5_code = md5(fp['body']).hexdigest()
-            sha1_code = sha1(fp['body']).hexdigest()
+            md5_code = fp.md5.hexdigest()
+            sha1_code = fp.sha1.hexdigest()
 
-            exist = self.image.find_one({
-                'md5_code': md5_code,
-                'sha1_code': sha1_code
-            })
+            exist = yield find_image(self.image, md5_code, sha1_code)
             if exist:
+                yield claim_image(self.image, exist)
                 file_list.append(
                     dict(
                         image_id=exist.get('image_id'),
@@ -85,10 +242,8 @@ class File(BaseHandler):
                         name=filename + ext))
                 continue
 
-            qcos_bucket.put_object(
-                path='/image/' + image_id + ext.lower(), body=fp['body'])
-
-            self.image.insert(
+            stored = yield self.store_image(
+                fp.file,
                 dict(
                     image_id=image_id,
                     user_id=_params.user_id,
@@ -100,14 +255,14 @@ class File(BaseHandler):
 
             file_list.append(
                 dict(
-                    image_id=image_id,
-                    path='/image/' + image_id + ext,
+                    image_id=stored['image_id'],
+                    path=stored['path'],
                     name=filename + ext))
 
         self.success(data=dict(file_list=file_list))
 
 
-class Image(BaseHandler):
+class Image(UploadHandler):
     """Handler image stuff."""
 
     @asynchronous
@@ -117,16 +272,15 @@ class Image(BaseHandler):
         if not _params:
             return
 
-        image_list = self.image.find(
+        res = yield self.image.find(
             dict(user_id=_params.user_id),
             projection={
                 '_id': 0,
                 'md5_code': 0,
                 'sha1_code': 0,
                 'user_id': 0
-            })
+            }).to_list()
 
-        res = list(image for image in image_list)
         self.success(data=res)
 
     @asynchronous
@@ -137,36 +291,24 @@ class Image(BaseHandler):
     @asynchronous
     @coroutine
     def put(self, *_args, **_kwargs):
-        _params = self.check_auth(2)
-        if not _params:
+        _params = self.upload_params
+        uploads = self.uploaded_files()
+        if uploads is None:
             return
 
-        file_meta = self.request.files
         file_list = []
-        for fp in file_meta['file']:
-            filename, ext = os.path.splitext(fp['filename'])
+        for fp in uploads:
+            filename, ext = os.path.splitext(fp.filename)
 
             ext = ext.lower()
             image_id = str(uuid())
-            md5_code = md5(fp['body']).hexdigest()
-            sha1_code = sha1(fp['body']).hexdigest()
+            md5_code = fp.md5.hexdigest()
+            sha1_code = fp.sha1.hexdigest()
 
-            exist = self.image.find_one({
-                'md5_code': md5_code,
-                'sha1_code': sha1_code
-            })
+            exist = yield find_image(self.image, md5_code, sha1_code)
             if exist:
-                if 'user_id' not in exist:
-                    self.image.update_one({
-                        'md5_code': md5_code,
-                        'sha1_code': sha1_code
-                    }, {
-                        '$set': {
-                            'user_id': _params.user_id,
-                            'update_time': int(time.time()),
-                            'name': filename + ext
-                        }
-                    })
+                yield claim_image(
+                    self.image, exist, _params.user_id, filename + ext)
                 file_list.append(
                     dict(
                         image_id=exist.get('image_id'),
@@ -174,10 +316,8 @@ class Image(BaseHandler):
                         name=filename + ext))
                 continue
 
-            res = qcos_bucket.put_object(
-                path=f'/image/' + image_id + ext.lower(), body=fp['body'])
-
-            self.image.insert(
+            stored = yield self.store_image(
+                fp.file,
                 dict(
                     image_id=image_id,
                     md5_code=md5_code,
@@ -188,8 +328,8 @@ class Image(BaseHandler):
 
             file_list.append(
                 dict(
-                    image_id=image_id,
-                    path=f'/middle/image/record/' + image_id + ext,
+                    image_id=stored['image_id'],
+                    path=stored['path'],
                     name=filename + ext))
 
         self.success(data=dict(file_list=file_list))
@@ -203,13 +343,15 @@ class Image(BaseHandler):
 
         args = self.parse_form_arguments(image_id=ENFORCED)
 
-        image_info = self.image.find_one_and_delete(
+        image_info = yield self.image.find_one_and_delete(
             dict(image_id=args.image_id))
 
         if not image_info:
-            self.fail(4004)
+            return self.fail(4004)
 
-        qcos_bucket.delete_object(path=image_info['path'])
+        yield self.trace.track(
+            'cos delete_object',
+            qcos_bucket.delete_object(path=image_key(image_info['path'])))
 
         self.success()
 
@@ -224,7 +366,7 @@ class ImageRecord(BaseHandler):
     @asynchronous
     @coroutine
     def get(self, *_args, **_kwargs):
-        source = self.request.uri.split('/')[-1]
+        source = self.request.path.split('/')[-1]
         referer = self.request.headers.get('Referer')
 
         if not referer or not re.search(self.referer_checker, referer):
@@ -234,7 +376,7 @@ class ImageRecord(BaseHandler):
         image_id, ext = os.path.splitext(source)
 
         if re.match(self.id_checker, image_id):
-            self.image.find_one_and_update({
+            yield self.image.find_one_and_update({
                 'image_id': image_id
             }, {
                 '$set': {
@@ -242,11 +384,137 @@ class ImageRecord(BaseHandler):
                 }
             })
 
-        self.redirect('/image/' + source)
+        # Keep the query, ?w=<width> asks for a resized variant.
+        query = self.request.query
+        self.redirect('/image/' + source + ('?' + query if query else ''))
+
+
+class ImageExists(BaseHandler):
+    """Skip the upload of an image whose content is stored already.
+
+    The browser sends the md5, sha1 and size of a file. If no image has
+    this content, `exists` is false and the file goes by `PUT /image`.
+    Otherwise a byte range of the file is picked at random and sent back
+    with a signed `challenge`. The browser posts again with the challenge
+    and the sha1 of that range as `proof`; the range is read from COS, and
+    if it matches the image is taken as `PUT /image` would take it.
+
+    Digests alone are no proof of having the content, so without a proof
+    nothing is claimed and no path is answered.
+    """
+
+    digest_checker = dict(
+        md5_code=re.compile(r'^[0-9a-f]{32}$'),
+        sha1_code=re.compile(r'^[0-9a-f]{40}$'))
+    proof_size = config.get('image_dedup.proof_size', 64 * 1024)
+    challenge_ttl = config.get('image_dedup.challenge_ttl', 300)
+
+    @asynchronous
+    @coroutine
+    def post(self, *_args, **_kwargs):
+        _params = self.check_auth(2)
+        if not _params:
+            return
+
+        args = self.parse_json_arguments(
+            md5_code=ENFORCED, sha1_code=ENFORCED, size=OPTIONAL,
+            name=OPTIONAL, challenge=OPTIONAL, proof=OPTIONAL)
+        for key, checker in self.digest_checker.items():
+            if not checker.match(str(args.get(key, '')).lower()):
+                raise HTTPError(400, f'Invalid {key}.')
+        md5_code = args.md5_code.lower()
+        sha1_code = args.sha1_code.lower()
+
+        exist = yield find_image(self.image, md5_code, sha1_code)
+        if not exist:
+            return self.success(data=dict(exists=False))
+
+        if not args.challenge:
+            return self.success(
+                data=dict(
+                    exists=True,
+                    **self.make_challenge(md5_code, sha1_code, args.size,
+                                          _params.user_id)))
+
+        challenge = self.read_challenge(args.challenge)
+        if not challenge or challenge['user_id'] != _params.user_id or \
+                challenge['md5_code'] != md5_code or \
+                challenge['sha1_code'] != sha1_code:
+            self.set_status(403)
+            return self.fail(4005)
+
+        proven = yield self.check_proof(exist, challenge, args.proof)
+        if not proven:
+            self.set_status(403)
+            return self.fail(4005)
+
+        name = args.name or exist.get('name')
+        yield claim_image(self.image, exist, _params.user_id, name)
+        self.success(
+            data=dict(
+                exists=True,
+                image_id=exist.get('image_id'),
+                path=exist.get('path'),
+                name=name))
+
+    def make_challenge(self, md5_code, sha1_code, size, user_id):
+        """Pick a random byte range of a file of `size` bytes to prove."""
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise HTTPError(400, 'Invalid size.')
+        if size <= 0:
+            raise HTTPError(400, 'Invalid size.')
+
+        length = min(self.proof_size, size)
+        offset = secrets.randbelow(size - length + 1)
+        challenge = self.create_signed_value(
+            'image_challenge',
+            json.dumps(
+                dict(
+                    md5_code=md5_code,
+                    sha1_code=sha1_code,
+                    user_id=user_id,
+                    offset=offset,
+                    length=length,
+                    expire=int(time.time()) + self.challenge_ttl)))
+        return dict(offset=offset, length=length, challenge=challenge.decode())
+
+    def read_challenge(self, value):
+        """The content of a challenge, None if forged or expired."""
+        value = decode_signed_value(
+            self.application.settings['cookie_secret'], 'image_challenge',
+            str(value))
+        if value is None:
+            return None
+        challenge = json.loads(value.decode())
+        if challenge['expire'] < time.time():
+            return None
+        return challenge
+
+    @coroutine
+    def check_proof(self, exist, challenge, proof):
+        """Check `proof` is the sha1 of the challenged range in COS."""
+        start = challenge['offset']
+        end = start + challenge['length'] - 1
+        try:
+            res = yield self.trace.track(
+                'cos get_object',
+                qcos_bucket.get_object(
+                    path=image_key(exist['path']),
+                    Range=f'bytes={start}-{end}'))
+        except (CosClientError, CosServiceError):
+            # A range past the end of the object, if the size was wrong.
+            return False
+        if len(res['body']) != challenge['length']:
+            return False
+        return hmac.compare_digest(
+            sha1(res['body']).hexdigest(), str(proof or '').lower())
 
 
 FILE_URLS = [
     (r'/file', File),
     (r'/image', Image),
+    (r'/image/exists', ImageExists),
     (r'/image/record/.*', ImageRecord),
 ]
@@ -5,7 +5,7 @@ from tornado.gen import coroutine
 from tornado.web import asynchronous
 
 from base_handler import BaseHandler, ENFORCED, OPTIONAL
-from workers.task_database import TASKS as tasks
+from models.session_store import SESSION_STORE
 from config import CFG as config
 
 
@@ -17,16 +17,14 @@ class AuthGuard(BaseHandler):
     def get(self, *_args, **_kwargs):
         _params = self.check_auth(2)
         if not _params:
-            self.session.update({
-                'ip': self.request.remote_ip
-            }, {
-                '$set': {
-                    'user_id': ''
-                }
-            })
+            yield SESSION_STORE.update(
+                self.request.remote_ip, dict(user_id=''))
             return
 
-        self.success(data=_params[0])
+        self.success(data={
+            key: value
+            for key, value in _params[0].items() if key != '_issued'
+        })
 
 
 class ArticleOwnerGuard(BaseHandler):
@@ -41,7 +39,8 @@ class ArticleOwnerGuard(BaseHandler):
 
         args = self.parse_form_arguments(article_id=ENFORCED)
 
-        query_result = tasks.query_article(article_id=args.article_id)
+        query_result = yield self.tasks.query_article.delay(
+            article_id=args.article_id)
 
         if not query_result:
             return self.fail(4004)
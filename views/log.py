@@ -5,9 +5,12 @@ from uuid import uuid1 as uuid
 import time
 from hashlib import md5
 from tornado.gen import coroutine
-from tornado.web import asynchronous
+from tornado.web import HTTPError, asynchronous
 
 from base_handler import BaseHandler, ENFORCED, OPTIONAL
+from models.access_log import ACCESS_LOG
+from models.access_rollup import ACCESS_ROLLUP, KINDS
+from models.session_store import SESSION_STORE
 
 
 class AccessLog(BaseHandler):
@@ -27,15 +30,9 @@ class Credit(BaseHandler):
     def post(self, *_args, **_kwargs):
         _params = self.check_auth(1)
         if _params:
-            self.session.update(
-                {
-                    'ip': self.request.remote_ip
-                }, {
-                    '$set': {
-                        'user_id': _params.user_id,
-                        'user_name': _params.user_name
-                    }
-                },
+            yield SESSION_STORE.update(
+                self.request.remote_ip,
+                dict(user_id=_params.user_id, user_name=_params.user_name),
                 upsert=True)
 
         args = self.parse_json_arguments(
@@ -46,7 +43,12 @@ class Credit(BaseHandler):
 
         mixin = self.get_secure_cookie('koo').decode()
 
-        session = self.session.find_one({'ip': self.request.remote_ip})
+        session = yield SESSION_STORE.get(self.request.remote_ip)
+
+        if not session or session.get('mixin') != mixin:
+            # The mixin may have been changed by another worker.
+            session = yield SESSION_STORE.get(
+                self.request.remote_ip, fresh=True)
 
         if not session:
             return self.fail(4003)
@@ -71,19 +73,14 @@ class Credit(BaseHandler):
                 user_name=session.get('user_name', ''),
                 session_id=session.get('session_id', '')))
 
-        self.access_log.insert(description)
+        ACCESS_LOG.append(description)
 
         if str(time.time())[-1] == '4':
             base = str(time.time()).encode()
             credit = md5(base).hexdigest()
 
-            self.session.update({
-                'ip': self.request.remote_ip
-            }, {
-                '$set': {
-                    'mixin': credit
-                }
-            })
+            yield SESSION_STORE.update(
+                self.request.remote_ip, dict(mixin=credit), flush=True)
 
             self.set_secure_cookie(
                 'koo', credit.encode(), domain=self.request.host)
@@ -100,14 +97,11 @@ class Favicon(BaseHandler):
         base = str(time.time()).encode()
         credit = md5(base).hexdigest()
 
-        self.session.update(
-            {
-                'ip': self.request.remote_ip
-            }, {'$set': {
-                'mixin': credit,
-                'session_id': uuid().hex
-            }},
-            upsert=True)
+        yield SESSION_STORE.update(
+            self.request.remote_ip,
+            dict(mixin=credit, session_id=uuid().hex),
+            upsert=True,
+            flush=True)
 
         self.set_secure_cookie(
             'koo', credit.encode(), domain=self.request.host)
@@ -116,8 +110,44 @@ class Favicon(BaseHandler):
         self.finish(res.res_body)
 
 
+class AccessStats(BaseHandler):
+    """Handle access stats, read from the rollups only.
+
+    Counts are per user, so only the internal addresses may read them.
+    """
+
+    @asynchronous
+    @coroutine
+    def get(self, *_args, **_kwargs):
+        if not self.check_internal():
+            return
+
+        args = self.parse_form_arguments(
+            kind=ENFORCED, since=OPTIONAL, until=OPTIONAL, key=OPTIONAL,
+            limit=OPTIONAL)
+
+        if args.kind not in KINDS:
+            return self.fail(4004)
+
+        try:
+            since = int(args.since) if args.since else None
+            until = int(args.until) if args.until else None
+            limit = min(int(args.limit or 20), 200)
+        except ValueError:
+            raise HTTPError(400, 'Invalid since, until or limit.')
+        if limit < 1:
+            raise HTTPError(400, 'Invalid limit.')
+        keys = args.key.split(',') if args.key else None
+
+        stats = yield ACCESS_ROLLUP.stats(
+            args.kind, since=since, until=until, keys=keys, limit=limit)
+
+        self.success(data=dict(kind=args.kind, stats=stats))
+
+
 LOG_URLS = [
     (r'/log/access', AccessLog),
     (r'/log/credit', Credit),
+    (r'/log/stats', AccessStats),
     (r'/js/loading.js', Favicon),
 ]
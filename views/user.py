@@ -5,7 +5,7 @@ from tornado.gen import coroutine
 from tornado.web import asynchronous
 
 from base_handler import BaseHandler, ENFORCED
-from workers.task_database import TASKS as tasks
+from utils.cache import ARTICLE_CACHE, LIST_CACHE
 
 
 class User(BaseHandler):
@@ -16,10 +16,10 @@ class User(BaseHandler):
     def post(self, *_args, **_kwargs):
         args = self.parse_json_arguments(name=ENFORCED, password=ENFORCED)
 
-        user_info = tasks.query_user(username=args.name)
+        user_info = yield self.tasks.query_user.delay(username=args.name)
 
         if not user_info:
-            user_info = tasks.query_user(email=args.name)
+            user_info = yield self.tasks.query_user.delay(email=args.name)
 
         if not user_info:
             return self.fail(3011)
@@ -51,21 +51,29 @@ class User(BaseHandler):
         if not self.pattern_match('password', args.password):
             return self.fail(3031)
 
-        exists_result = tasks.query_email_or_username_exists(
+        uow_tasks = self.tasks.bind(uow=self.uow)
+
+        exists_result = yield uow_tasks.query_email_or_username_exists.delay(
             username=args.username, email=args.email)
         if exists_result:
             return self.fail(3004)
 
-        insert_result = tasks.insert_user(
+        insert_result = yield uow_tasks.insert_user.delay(
             username=args.username,
             email=args.email,
             pswd=md5(args.password.encode()).hexdigest())
+        if not insert_result['result']:
+            return self.fail(5003)
 
-        insert_result = tasks.insert_category(
+        insert_result = yield uow_tasks.insert_category.delay(
             category_name='默认分类',
             category_type=0,
             user_id=insert_result['data']['user_id'])
 
+        committed = yield self.uow.commit()
+        if not committed:
+            return self.fail(5003)
+
         self.success()
 
     def delete(self, *_args, **_kwargs):
@@ -86,12 +94,21 @@ class UserProfile(BaseHandler):
 
         args = self.parse_json_arguments(name=ENFORCED)
 
-        exists_result = tasks.query_username_exists(username=args.name)
+        uow_tasks = self.tasks.bind(uow=self.uow)
+
+        exists_result = yield uow_tasks.query_username_exists.delay(
+            username=args.name)
 
         if exists_result:
             return self.fail(3004)
 
-        tasks.update_user_name(user_id=_params.user_id, username=args.name)
+        yield uow_tasks.update_user_name.delay(
+            user_id=_params.user_id, username=args.name)
+        committed = yield self.uow.commit()
+        if not committed:
+            return self.fail(5003)
+        ARTICLE_CACHE.discard_by('user_id', _params.user_id)
+        LIST_CACHE.clear()
 
         _params.add('user_name', args.name)
         self.set_parameters(_params[0])
@@ -110,7 +127,9 @@ class UserPassword(BaseHandler):
 
         args = self.parse_json_arguments(old_pass=ENFORCED, new_pass=ENFORCED)
 
-        user_info = tasks.query_user(user_id=_params.user_id)
+        uow_tasks = self.tasks.bind(uow=self.uow)
+
+        user_info = yield uow_tasks.query_user.delay(user_id=_params.user_id)
 
         if not user_info:
             return self.fail(4004)
@@ -119,10 +138,13 @@ class UserPassword(BaseHandler):
         new_md5 = md5(args.new_pass.encode()).hexdigest()
 
         if old_md5 != user_info['pswd']:
-            print(old_md5, user_info['pswd'])
             return self.fail(3001)
 
-        tasks.update_user_pass(user_id=_params.user_id, pswd=new_md5)
+        yield uow_tasks.update_user_pass.delay(
+            user_id=_params.user_id, pswd=new_md5)
+        committed = yield self.uow.commit()
+        if not committed:
+            return self.fail(5003)
 
         self.success()
 
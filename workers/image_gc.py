@@ -0,0 +1,129 @@
+# coding:utf-8
+"""Delete uploaded images no article refers to.
+
+An image is collected when no article content mentions its id and it has
+not been uploaded or viewed through /image/record for
+`image_gc.retention_days`. Objects are removed from COS in batches of up
+to 1000 with one delete_objects call each, then their records are removed
+from the image collection with one bulk write per batch. Records of
+objects COS failed to delete are kept, so the next run retries them.
+
+    python -m workers.image_gc              # report what would be deleted
+    python -m workers.image_gc --delete
+
+Run it from cron, at most once per retention window is enough.
+"""
+
+import logging
+import re
+import sys
+import time
+
+from pymongo import DeleteOne
+
+from lib.qcos.bucket import Bucket
+from models import Article
+from models.lazor_mongo import ARTICLE_CONTENT, IMAGE
+from workers import O_O
+from workers.manager import SESS
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000  # the most objects delete_objects takes
+
+# Images are linked as /image/<id>.<ext> or /middle/image/record/<id>.<ext>.
+IMAGE_REFERENCE = re.compile(r'image/(?:record/)?'
+                             r'([0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}'
+                             r'-[0-9a-fA-F]{12})')
+
+
+def image_key(path):
+    """COS key of an image record's path, both link forms map to it."""
+    return 'image/' + path.rsplit('/', 1)[-1]
+
+
+def referenced_ids():
+    """Ids of every image an article content refers to."""
+    ids = set()
+    for doc in ARTICLE_CONTENT.find({}, {'_id': 0, 'content': 1}):
+        ids.update(IMAGE_REFERENCE.findall(doc.get('content') or ''))
+
+    sess = SESS()
+    try:
+        query = sess.query(Article.content).filter(Article.content != '')
+        for content, in query.yield_per(1000):
+            ids.update(IMAGE_REFERENCE.findall(content))
+    finally:
+        sess.close()
+    return ids
+
+
+def orphan_batches(referenced, cutoff):
+    """Yield lists of unreferenced image records older than cutoff."""
+    batch = []
+    cursor = IMAGE.find(
+        {'update_time': {'$lt': cutoff}},
+        {'_id': 0, 'image_id': 1, 'path': 1}).batch_size(BATCH_SIZE)
+    for image in cursor:
+        if image['image_id'] in referenced:
+            continue
+        batch.append(image)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def delete_batch(bucket, batch):
+    """Delete a batch from COS and then Mongo, return the count deleted."""
+    keys = {image_key(image['path']): image for image in batch}
+    res = bucket.delete_objects(list(keys), quiet='true')
+
+    failed = set()
+    for error in res['body'].get('Error') or []:
+        logger.warning('delete of %s failed: %s', error.get('Key'),
+                       error.get('Message'))
+        failed.add(error.get('Key'))
+
+    requests = [
+        DeleteOne({'image_id': image['image_id']})
+        for key, image in keys.items() if key not in failed
+    ]
+    if not requests:
+        return 0
+    return IMAGE.bulk_write(requests, ordered=False).deleted_count
+
+
+def run(delete=False, retention_days=None):
+    """Collect orphan images, return the number deleted or found."""
+    if retention_days is None:
+        retention_days = O_O.get('image_gc.retention_days', 30)
+    cutoff = int(time.time()) - retention_days * 86400
+    referenced = referenced_ids()
+
+    bucket = None
+    if delete:
+        bucket = Bucket(
+            bucket=O_O.cos.bucket,
+            access_id=O_O.cos.access_id,
+            access_key=O_O.cos.access_key,
+            region=O_O.cos.region,
+            appid=O_O.cos.appid,
+            retry=O_O.get('cos.retry', 1))
+
+    total = 0
+    for batch in orphan_batches(referenced, cutoff):
+        if bucket is None:
+            for image in batch:
+                print(f'orphan  {image["image_id"]}  {image["path"]}')
+            total += len(batch)
+        else:
+            total += delete_batch(bucket, batch)
+    print(f'{"deleted" if delete else "found"} {total} orphan images, '
+          f'{len(referenced)} referenced')
+    return total
+
+
+if __name__ == '__main__':
+    run(delete='--delete' in sys.argv[1:])
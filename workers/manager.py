@@ -1,29 +1,201 @@
 # coding:utf-8
 """Module of celery task queue manager."""
 
-import traceback
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
-from sqlalchemy import create_engine, exc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
+from utils.metrics import Counter, Gauge, Histogram
+from utils.prefork import on_fork
 from workers import env, O_O
 
-DB_ENGINE = create_engine(
-    O_O.mysql, echo=False, pool_recycle=100, encoding='utf-8')
+logger = logging.getLogger(__name__)
+
+DB_POOL_WAIT = Histogram(
+    'db_pool_checkout_seconds', 'Time to get a connection from the pool.')
+DB_POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts_total', 'Checkouts given up after pool_timeout.')
+DB_POOL_EVENTS = Counter(
+    'db_pool_events_total', 'Pool events: connect, checkout, invalidate.',
+    labels=('event', ))
+DB_TASK_LATENCY = Histogram(
+    'db_task_seconds', 'Run time of a database task.', labels=('task', ))
+DB_TASK_ERRORS = Counter(
+    'db_task_errors_total', 'Database tasks that raised.', labels=('task', ))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool recording how long checkouts wait."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - start)
+
+
+def _count_pool_events(engine):
+    for name in ('connect', 'checkout', 'invalidate'):
+        event.listen(
+            engine, name,
+            lambda *_args, name=name: DB_POOL_EVENTS.inc(event=name))
+
+
+def _create_engine():
+    engine = create_engine(
+        O_O.mysql,
+        echo=False,
+        encoding='utf-8',
+        poolclass=InstrumentedQueuePool,
+        pool_size=O_O.get('db_pool.pool_size', 10),
+        max_overflow=O_O.get('db_pool.max_overflow', 5),
+        pool_timeout=O_O.get('db_pool.pool_timeout', 10),
+        pool_recycle=O_O.get('db_pool.pool_recycle', 100),
+        pool_pre_ping=O_O.get('db_pool.pool_pre_ping', True))
+    _count_pool_events(engine)
+    return engine
+
+
+def _create_executor():
+    # Keep it no larger than db_pool.pool_size, or the extra threads just
+    # queue up on a connection checkout.
+    return ThreadPoolExecutor(max_workers=O_O.get('executor.max_workers', 10))
+
+
+def _create_unit_executor():
+    # Commits and closes of units of work give connections back to the
+    # pool. On EXECUTOR they could queue behind tasks blocked on a checkout
+    # waiting for those very connections, so they get threads of their own,
+    # which never check out a connection.
+    return ThreadPoolExecutor(max_workers=2)
+
+
+class DeferredSession(Session):
+    """Session whose `commit` only flushes, see `UnitOfWork`."""
+
+    def commit(self):
+        self.flush()
+
+    def commit_unit(self):
+        """Commit the transaction for real."""
+        super(DeferredSession, self).commit()
+
+
+DB_ENGINE = _create_engine()
 
 SESS = sessionmaker(bind=DB_ENGINE)
 
+UOW_SESS = sessionmaker(bind=DB_ENGINE, class_=DeferredSession)
+
+EXECUTOR = _create_executor()
+
+UNIT_EXECUTOR = _create_unit_executor()
+
+Gauge('db_pool_size', 'Connections kept in the pool.',
+      function=lambda: DB_ENGINE.pool.size())
+Gauge('db_pool_checked_out', 'Connections in use.',
+      function=lambda: DB_ENGINE.pool.checkedout())
+Gauge('db_pool_overflow', 'Connections opened past pool_size.',
+      function=lambda: max(DB_ENGINE.pool.overflow(), 0))
+Gauge('db_executor_queue', 'Tasks waiting for an executor thread.',
+      function=lambda: EXECUTOR._work_queue.qsize())
+
+
+@on_fork
+def reset_engine():
+    """Re-create the engine and the executor in a forked worker.
+
+    Pooled connections and executor threads can not be shared with the
+    parent process.
+    """
+    global DB_ENGINE, EXECUTOR, UNIT_EXECUTOR
+    DB_ENGINE = _create_engine()
+    SESS.configure(bind=DB_ENGINE)
+    UOW_SESS.configure(bind=DB_ENGINE)
+    EXECUTOR = _create_executor()
+    UNIT_EXECUTOR = _create_unit_executor()
+
+
+class UnitOfWork:
+    """One session and transaction shared by the tasks of a request.
+
+    Pass it to tasks as `uow=`, the commits of the tasks only flush, and
+    `commit` commits once at the end. The session holds its pooled
+    connection until `close`. If a task fails the transaction is rolled
+    back and `commit` does nothing and resolves to False.
+
+    The tasks must run one after another, as a handler yielding each one
+    does, since a session can not be used by two threads at once.
+    """
+
+    def __init__(self):
+        self._session = None
+        self.failed = False
+
+    @property
+    def session(self):
+        """The session, created on first use."""
+        if self._session is None:
+            self._session = UOW_SESS()
+        return self._session
+
+    def rollback(self):
+        """Roll back the work done so far and mark the unit failed."""
+        self.failed = True
+        if self._session is not None:
+            self._session.rollback()
+
+    def _commit(self):
+        if self.failed:
+            return False
+        if self._session is None:
+            return True
+        try:
+            self._session.commit_unit()
+        except exc.SQLAlchemyError:
+            logger.exception('commit of unit of work failed')
+            self.rollback()
+            return False
+        return True
+
+    def commit(self):
+        """Commit in a thread, return a future of True on success.
+
+        Runs on `UNIT_EXECUTOR`, not behind the queued tasks on `EXECUTOR`.
+        """
+        return UNIT_EXECUTOR.submit(self._commit)
+
+    def _close(self, session):
+        session.close()
+
+    def close(self):
+        """Roll back anything not committed and release the connection."""
+        if self._session is not None:
+            session, self._session = self._session, None
+            UNIT_EXECUTOR.submit(self._close, session)
+
 
 def exc_handler(function):
     """Wrap a handle shell to a query function."""
 
     @wraps(function)
-    def wrapper(*args, **kwargs):
+    def wrapper(*args, uow=None, trace=None, **kwargs):
         """Function that wrapped."""
-        session = SESS()
+        session = SESS() if uow is None else uow.session
+        failed = True
+        start = time.perf_counter()
         try:
             res = function(sess=session, *args, **kwargs)
+            failed = False
         except exc.IntegrityError as exception:
             res = dict(result=0, status=1, msg=str(exception.orig))
         except exc.ProgrammingError as exception:
@@ -35,13 +207,35 @@ def exc_handler(function):
         except UnicodeEncodeError as exception:
             res = dict(result=0, status=5, msg=str(exception))
         except:
-            print('my exception\n\n')
-            traceback.print_exc()
-            print('=' * 80, '\n\n')
+            logger.exception('task %s failed', function.__name__)
             res = dict(result=0, status=255, msg='Unknown Error.')
         finally:
-            session.close()
+            if uow is None:
+                session.close()
+            elif failed:
+                uow.rollback()
+            DB_TASK_LATENCY.observe(
+                time.perf_counter() - start, task=function.__name__)
+            if trace is not None:
+                trace.record(f'task {function.__name__}', start,
+                             time.perf_counter())
+            if failed:
+                DB_TASK_ERRORS.inc(task=function.__name__)
 
         return res
 
+    def delay(*args, trace=None, **kwargs):
+        """Run the task on the executor, return a future of its result.
+
+        The future can be yielded from a tornado coroutine, so the IOLoop
+        keeps serving other requests while MySQL works. With `trace`, the
+        span includes the time waiting for an executor thread.
+        """
+        future = EXECUTOR.submit(wrapper, *args, **kwargs)
+        if trace is not None:
+            trace.track(f'task {function.__name__}', future)
+        return future
+
+    wrapper.delay = delay
+
     return wrapper
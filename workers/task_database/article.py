@@ -3,7 +3,7 @@
 import time
 from uuid import uuid1 as uuid
 
-from sqlalchemy import desc
+from sqlalchemy import and_, desc, or_
 
 from models import Article, User, Category
 from workers.manager import exc_handler
@@ -59,12 +59,17 @@ def query_article(article_id, **kwargs):
 
 @exc_handler
 def query_article_info_list(**kwargs):
-    """Query Article Info."""
+    """Query Article Info, newest first.
+
+    Pass `before=(create_time, article_id)` of the last article of a page
+    to get the articles after it.
+    """
     sess = kwargs.get('sess')
 
     category_id = kwargs.get('category_id')
     publish_status = kwargs.get('publish_status')
     limit = kwargs.get('limit')
+    before = kwargs.get('before')
 
     article_list = sess.query(
         Article.article_id,
@@ -90,8 +95,16 @@ def query_article_info_list(**kwargs):
         article_list = article_list.filter(
             Article.publish_status == publish_status)
 
+    if before:
+        before_time, before_id = before
+        article_list = article_list.filter(or_(
+            Article.create_time < before_time,
+            and_(Article.create_time == before_time,
+                 Article.article_id < before_id)))
+
     article_list = article_list.order_by(
-        desc(Article.create_time)
+        desc(Article.create_time),
+        desc(Article.article_id)
     )
 
     if limit:
@@ -117,7 +117,6 @@ def update_user_name(user_id, username, **kwargs):
 def update_user_pass(user_id, pswd, **kwargs):
     """Insert a user."""
     sess = kwargs.get('sess')
-    print(pswd)
 
     update_result = sess.query(User).filter(User.user_id == user_id).update({
         User.pswd: pswd